@@ -0,0 +1,103 @@
+import bisect
+import ipaddress
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+
+import redis.asyncio as redis
+
+IPAddress = ipaddress.IPv4Address | ipaddress.IPv6Address
+
+
+class NetworkSet:
+    # networks merged into sorted address ranges, so a lookup is a single bisect
+    def __init__(self, networks: Iterable[str]) -> None:
+        nets = sorted((ipaddress.ip_network(n) for n in networks), key=lambda n: (n.version, n.network_address))
+        self.ranges: dict[int, tuple[list[int], list[int]]] = {4: ([], []), 6: ([], [])}
+        for net in nets:
+            starts, ends = self.ranges[net.version]
+            start, end = int(net.network_address), int(net.broadcast_address)
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    def __contains__(self, addr: IPAddress) -> bool:
+        if isinstance(addr, ipaddress.IPv6Address) and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        starts, ends = self.ranges[addr.version]
+        i = bisect.bisect_right(starts, int(addr)) - 1
+        return i >= 0 and int(addr) <= ends[i]
+
+
+@dataclass
+class DayVisits:
+    count: int = 0
+    first_access: int = 0
+    visitors: set[str] = field(default_factory=set)
+
+
+@dataclass
+class DayStats:
+    count: int = 0
+    first_access: int = 0
+    unique_visitors: int = 0
+
+
+class Visits:
+    # counted in process and written to redis in batches by flush()
+    def __init__(self, excluded: NetworkSet, ttl: int) -> None:
+        self.excluded = excluded
+        self.ttl = ttl
+        self.pending: dict[str, DayVisits] = {}
+        # totals as of the last flush, so the statistics can be served without asking redis
+        self.totals: dict[str, DayStats] = {}
+        # visitors this worker already flushed, so the buffered ones are not counted twice
+        self.flushed: dict[str, set[str]] = {}
+
+    def record(self, key: str, host: str, now: int) -> bool:
+        try:
+            if ipaddress.ip_address(host) in self.excluded:
+                return False
+        except ValueError:
+            return False
+        day = self.pending.setdefault(key, DayVisits(first_access=now))
+        day.count += 1
+        day.visitors.add(host)
+        return True
+
+    def unflushed(self, key: str) -> DayVisits:
+        return self.pending.get(key) or DayVisits()
+
+    def new_visitors(self, key: str) -> int:
+        return len(self.unflushed(key).visitors - self.flushed.get(key, set()))
+
+    async def flush(self, redis_client: redis.Redis) -> None:
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for key, day in pending.items():
+                    pipe.incrby(f"{key}.access_count", day.count)
+                    pipe.setnx(f"{key}.first_access", day.first_access)
+                    pipe.pfadd(f"{key}.visitors", *day.visitors)
+                    pipe.get(f"{key}.first_access")
+                    pipe.pfcount(f"{key}.visitors")
+                    for name in ("access_count", "first_access", "visitors"):
+                        pipe.expire(f"{key}.{name}", self.ttl)
+                results = await pipe.execute()
+        except Exception:
+            # keep the visits for the next flush
+            for key, day in pending.items():
+                current = self.pending.setdefault(key, DayVisits(first_access=day.first_access))
+                current.count += day.count
+                current.first_access = min(current.first_access, day.first_access)
+                current.visitors |= day.visitors
+            raise
+
+        for i, key in enumerate(pending):
+            count, _, _, first_access, unique_visitors = results[i * 8 : i * 8 + 5]
+            self.totals[key] = DayStats(int(count), int(first_access), int(unique_visitors))
+        # only the days just flushed are kept, older ones are done
+        self.flushed = {key: self.flushed.get(key, set()) | day.visitors for key, day in pending.items()}
@@ -1,46 +1,170 @@
 #!/usr/bin/env -S uv run --script
 import asyncio
+import contextlib
+import dataclasses
 import datetime
-import ipaddress
+import gzip
+import hashlib
+import json
 import logging
 import os
-import pickle
-from typing import cast
+import re
+import secrets
+import time
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Annotated, cast
 from zoneinfo import ZoneInfo
 
+import brotli
+import httpx
 import redis.asyncio as redis
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Query, Request
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
-from starlette.responses import FileResponse, HTMLResponse
+from pydantic import BaseModel, TypeAdapter
+from redis.typing import EncodableT, FieldT
+from starlette.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 
 # from werkzeug.middleware.proxy_fix import ProxyFix
 # from flask_redis import FlaskRedis
-from lunches import RestaurantMenu, gather_restaurants
-from public_transport import public_transport_connections
+import analytics
+import archive
+import lunches
+import menu_index
+import metrics
+import public_transport as idos
+from lunches import Location, RestaurantMenu, restaurant_parsers, stream_restaurants
+from public_transport import Link, public_transport_connections
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING").upper()
 TZ = ZoneInfo("Europe/Prague")
+RESTAURANT_TTL = 60 * 60 * 24
+RESTAURANT_STALE_AFTER = 60 * 60
+REFRESH_TIMEOUT = 60 * 3
+# how many times a requested refresh waits for refreshes of other workers before giving up
+REFRESH_ATTEMPTS = 3
+# how long a visitor without any cached menus waits for the running refresh
+REFRESH_WAIT = 30
+# restaurants not fetched by then are written to the payload as pending, so the waiting visitors get the rest
+REFRESH_DEADLINE = 10
+# times of day when menus are fetched before anyone asks for them
+PREFETCH_PLAN = sorted(
+    datetime.time.fromisoformat(t) for t in os.getenv("PREFETCH_PLAN", "09:30,10:30,11:15").split(",") if t.strip()
+)
+PREFETCH_UNTIL = datetime.time.fromisoformat(os.getenv("PREFETCH_UNTIL", "14:00"))
+PREFETCH_TICK = 60
+# restaurants without a menu yet are polled again after these delays
+REPOLL_BACKOFF = [5 * 60, 10 * 60, 20 * 60, 40 * 60, 60 * 60]
+# processes parsing the downloaded pages, 0 parses them in the event loop
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "2"))
+# preferred order of precompressed /lunch.json payloads
+ENCODINGS = ("br", "gzip")
+# visits from these networks are not counted
+ANALYTICS_EXCLUDE = os.getenv(
+    "ANALYTICS_EXCLUDE", "127.0.0.0/8,::1/128,192.168.1.0/24,89.103.137.232/32,2001:470:5816::/48"
+).split(",")
+ANALYTICS_FLUSH_INTERVAL = 5
+# payloads kept in the worker, dropped sooner when any worker finishes a refresh
+PAYLOAD_CACHE_TTL = 60
+# deletes the lock only when it still holds our token, it might have expired and been taken by another worker
+RELEASE_LOCK = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+# fields changing on every fetch, left out of the restaurant content hash
+VOLATILE_FIELDS = {
+    "last_fetch",
+    # set just in the partial payload written at the refresh deadline
+    "pending",
+    "elapsed",
+    "elapsed_queue",
+    "elapsed_html_request",
+    "elapsed_parsing",
+    "elapsed_cleanup",
+}
 
 
 logging.basicConfig(level=LOG_LEVEL)
+LOGGER = logging.getLogger(__name__)
 
-app = FastAPI(debug=True)
+FETCH_SECONDS = metrics.Histogram("lunch_fetch_seconds", "Time spent downloading the restaurant page")
+PARSE_SECONDS = metrics.Histogram("lunch_parse_seconds", "Time spent parsing the restaurant page")
+CLEANUP_SECONDS = metrics.Histogram("lunch_cleanup_seconds", "Time spent normalizing the parsed foods")
+FETCH_ERRORS = metrics.Counter("lunch_fetch_errors_total", "Restaurants that failed to fetch or parse")
+CACHE_REQUESTS = metrics.Counter("lunch_cache_requests_total", "Requests of /lunch.json by the payload cache result")
+REDIS_SECONDS = metrics.Histogram("lunch_redis_seconds", "Redis round trip latency")
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global parse_executor, restaurant_http, idos_http
+    if PARSE_WORKERS:
+        parse_executor = ProcessPoolExecutor(PARSE_WORKERS)
+    try:
+        await asyncio.to_thread(archive.init)
+    except Exception:
+        LOGGER.exception("Creating the archive failed")
+    async with lunches.create_client() as restaurant_http, idos.create_client() as idos_http:
+        scheduler = asyncio.create_task(prefetch_scheduler())
+        flusher = asyncio.create_task(flush_visits())
+        invalidator = asyncio.create_task(invalidate_payloads())
+        yield
+        scheduler.cancel()
+        flusher.cancel()
+        invalidator.cancel()
+        await visits.flush(redis_client)
+    restaurant_http = idos_http = None
+    if parse_executor:
+        parse_executor.shutdown(cancel_futures=True)
+        parse_executor = None
+
+
+app = FastAPI(debug=True, lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 # app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1)
 redis_client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"))
-
-
-class ErrorResponse(BaseModel):
-    error: str
+restaurant_adapter = TypeAdapter(RestaurantMenu)
+circuit_adapter = TypeAdapter(lunches.Circuit)
+refreshes: dict[str, asyncio.Task[bool]] = {}
+# requested refreshes waiting for the running one, with the restaurants asked for
+queued_refreshes: dict[str, tuple[set[str], asyncio.Task[bool]]] = {}
+parse_executor: Executor | None = None
+payload_cache: dict[str, tuple[float, dict[bytes, bytes]]] = {}
+visits = analytics.Visits(
+    analytics.NetworkSet(net.strip() for net in ANALYTICS_EXCLUDE if net.strip()), ttl=RESTAURANT_TTL
+)
+# pooled upstream clients shared by all requests, owned by lifespan
+restaurant_http: httpx.AsyncClient | None = None
+idos_http: httpx.AsyncClient | None = None
 
 
 class LunchResponse(BaseModel):
     last_fetch: int
     fetch_count: int
-    access_count: int = 0
-    first_access: int = 0
     restaurants: list[RestaurantMenu]
+    locations: list[Location] = []
+    # grows with every change of any menu, never restarts unlike the day keys
+    version: int = 0
+    # set when restaurants are just the ones changed after that version
+    since: int | None = None
+    # content hash of every restaurant in the version, even those left out of restaurants
+    hashes: dict[str, str] = {}
+
+
+@dataclass
+class ParsedPayload:
+    etag: bytes
+    result: LunchResponse
+    index: menu_index.MenuIndex
+    # restaurant id -> version of its last change
+    versions: dict[str, int]
+
+
+# payloads parsed for ?q= and ?since=, rebuilt when the payload etag changes
+parsed_payloads: dict[Location | None, ParsedPayload] = {}
 
 
 @app.get("/")
@@ -48,63 +172,580 @@ def index() -> FileResponse:
     return FileResponse("index.html")
 
 
-@app.get("/public_transport")
-async def public_transport(request: Request) -> HTMLResponse:
+@app.get("/metrics")
+def prometheus_metrics() -> Response:
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def default_stops() -> tuple[list[str], list[str]]:
     srcs = ["Václava Jiřikovského"]
     dsts = ["Hlavní třída", "Rektorát VŠB", "Pustkovecká", "Poruba,Studentské koleje"]
     if datetime.datetime.now(TZ).hour >= 12:
         srcs, dsts = dsts, srcs
+    return srcs, dsts
 
+
+@app.get("/public_transport")
+async def public_transport(request: Request) -> HTMLResponse:
+    srcs, dsts = default_stops()
     return templates.TemplateResponse(
         request=request,
         name="public_transport.html",
-        context={"connections": await public_transport_connections(srcs, dsts)},
+        context={"connections": await public_transport_connections(srcs, dsts, idos_http, redis_client)},
     )
 
 
-@app.get("/lunch.json")
-@app.post("/lunch.json")
-async def lunch(request: Request) -> LunchResponse | ErrorResponse:
+@app.get("/public_transport.json")
+async def public_transport_json(
+    source: Annotated[list[str] | None, Query()] = None,
+    destination: Annotated[list[str] | None, Query()] = None,
+    window: Annotated[int, Query(ge=1, le=24 * 60, description="minutes from now")] = 60,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+) -> list[Link]:
+    srcs, dsts = default_stops()
+    return await public_transport_connections(
+        source or srcs,
+        destination or dsts,
+        idos_http,
+        redis_client,
+        window=datetime.timedelta(minutes=window),
+        limit=limit,
+    )
+
+
+@app.get("/search")
+async def search(
+    q: Annotated[str, Query(min_length=2)],
+    restaurant: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+) -> list[archive.DishStats]:
+    return await asyncio.to_thread(archive.search, q, restaurant, limit)
+
+
+def day_key(now: datetime.datetime) -> str:
+    return f"restaurants.{now.strftime('%d-%m-%Y')}"
+
+
+def observe_menu(menu: RestaurantMenu) -> None:
+    if menu.circuit_open and not menu.elapsed:
+        return
+    labels = {"restaurant": menu.id, "host": httpx.URL(menu.url).host}
+    FETCH_SECONDS.observe(menu.elapsed_queue + menu.elapsed_html_request, **labels)
+    if menu.error:
+        FETCH_ERRORS.inc(**labels)
+    elif menu.elapsed_parsing:
+        PARSE_SECONDS.observe(menu.elapsed_parsing, **labels)
+        CLEANUP_SECONDS.observe(menu.elapsed_cleanup, **labels)
+
+
+def payload_key(key: str, location: Location | None, kind: str = "payload") -> str:
+    return f"{key}.{kind}.{location}" if location else f"{key}.{kind}"
+
+
+def needs_refresh(menu: RestaurantMenu, now: int) -> bool:
+    return menu.error is not None or now - menu.last_fetch > RESTAURANT_STALE_AFTER
+
+
+def awaiting_menu(menu: RestaurantMenu) -> bool:
+    return menu.error is not None or not menu.lunches
+
+
+def encode_payload(result: BaseModel, encodings: tuple[str, ...] = ENCODINGS) -> dict[bytes, bytes]:
+    body = result.model_dump_json().encode()
+    payload = {b"etag": hashlib.sha256(body).hexdigest()[:32].encode(), b"identity": body}
+    if "gzip" in encodings:
+        payload[b"gzip"] = gzip.compress(body)
+    if "br" in encodings:
+        payload[b"br"] = brotli.compress(body)  # type: ignore[no-untyped-call]
+    return payload
+
+
+def accepted_encoding(request: Request, payload: dict[bytes, bytes]) -> str:
+    accepted = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, _, params = item.partition(";")
+        if not re.fullmatch(r"q=0(\.0*)?", params.strip()):
+            accepted.add(coding.strip())
+    return next((e for e in ENCODINGS if e in accepted and e.encode() in payload), "identity")
+
+
+def payload_response(request: Request, payload: dict[bytes, bytes], headers: dict[str, str]) -> Response:
+    encoding = accepted_encoding(request, payload)
+    suffix = "" if encoding == "identity" else f"-{encoding}"
+    headers |= {
+        "ETag": f'"{payload[b"etag"].decode()}{suffix}"',
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if headers["ETag"] in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(payload[encoding.encode()], media_type="application/json", headers=headers)
+
+
+async def wait_for_refresh(key: str) -> None:
+    async with redis_client.pubsub() as pubsub:
+        await pubsub.subscribe(f"{key}.refreshed")
+        # the lock also expires when its owner dies, so don't rely just on the notification
+        while await redis_client.exists(f"{key}.refreshing"):
+            await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+
+
+async def wait_for_payload(key: str, location: Location | None, refresh: asyncio.Task[bool]) -> dict[bytes, bytes]:
+    # ends with the partial payload written at the refresh deadline, not just with the whole refresh
+    deadline = time.monotonic() + REFRESH_WAIT
+    async with redis_client.pubsub() as pubsub:
+        await pubsub.subscribe(f"{key}.refreshed")
+        while True:
+            finished = refresh.done()
+            payload = cast(dict[bytes, bytes], await redis_client.hgetall(payload_key(key, location)))
+            if payload or finished or time.monotonic() >= deadline:
+                return payload
+            await pubsub.get_message(ignore_subscribe_messages=True, timeout=1)
+
+
+async def load_menus(key: str) -> tuple[list[str], dict[str, RestaurantMenu]]:
+    names = [parser.name for parser in restaurant_parsers()]
+    with REDIS_SECONDS.time(operation="load_menus"):
+        entries = await redis_client.mget([f"{key}.restaurant.{name}" for name in names])
+    return names, {name: restaurant_adapter.validate_json(raw) for name, raw in zip(names, entries, strict=True) if raw}
+
+
+def content_hash(menu: RestaurantMenu) -> str:
+    return hashlib.sha256(restaurant_adapter.dump_json(menu, exclude=VOLATILE_FIELDS)).hexdigest()[:16]
+
+
+def encode_payloads(
+    names: list[str],
+    menus: dict[str, RestaurantMenu],
+    fetch_count: int,
+    version: int = 0,
+    versions: dict[str, int] | None = None,
+) -> dict[Location | None, tuple[dict[bytes, bytes], dict[bytes, bytes]]]:
+    # the menus payload and its search index for every location
+    restaurants = [menus[name] for name in names if name in menus]
+    hashes = {menu.id: content_hash(menu) for menu in restaurants}
+    locations = [loc for loc in Location if restaurant_parsers(loc)]
+    payloads = {}
+    for location in [None, *locations]:
+        selected = [menu for menu in restaurants if location in (None, menu.location)]
+        response = LunchResponse(
+            last_fetch=max((menu.last_fetch for menu in selected), default=0),
+            fetch_count=fetch_count,
+            restaurants=selected,
+            locations=locations,
+            version=version,
+            hashes={menu.id: hashes[menu.id] for menu in selected},
+        )
+        payload = encode_payload(response)
+        # kept next to the payload for ?since=, but never sent
+        payload[b"versions"] = json.dumps(
+            {menu.id: (versions or {}).get(menu.id, version) for menu in selected}
+        ).encode()
+        payloads[location] = (payload, encode_payload(menu_index.build(selected)))
+    return payloads
+
+
+async def store_payloads(
+    key: str, names: list[str], menus: dict[str, RestaurantMenu], fetch_count: int, location: Location | None
+) -> None:
+    # the version moves only when the content of some restaurant changes, not its fetch times
+    hashes = {name: content_hash(menu) for name, menu in menus.items()}
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(f"{key}.hashes")
+        pipe.hgetall(f"{key}.versions")
+        pipe.get("restaurants.version")
+        stored_hashes, stored_versions, version = await pipe.execute()
+    versions = {name.decode(): int(v) for name, v in stored_versions.items()}
+    changed = [name for name, digest in hashes.items() if stored_hashes.get(name.encode()) != digest.encode()]
+    version = int(version or 0)
+    if changed:
+        version = await redis_client.incr("restaurants.version")
+        versions |= dict.fromkeys(changed, version)
+
+    # restaurants are shared, so payloads of all the locations with every restaurant fetched are rebuilt
+    async with redis_client.pipeline(transaction=False) as pipe:
+        if changed:
+            pipe.hset(f"{key}.hashes", mapping={name: hashes[name] for name in changed})
+            pipe.hset(f"{key}.versions", mapping={name: versions[name] for name in changed})
+            pipe.expire(f"{key}.hashes", RESTAURANT_TTL)
+            pipe.expire(f"{key}.versions", RESTAURANT_TTL)
+        for payload_location, (payload, index) in encode_payloads(names, menus, fetch_count, version, versions).items():
+            if payload_location != location and any(
+                parser.name not in menus for parser in restaurant_parsers(payload_location)
+            ):
+                continue
+            for scope, value in [
+                (payload_key(key, payload_location), payload),
+                (payload_key(key, payload_location, "index"), index),
+            ]:
+                pipe.hset(scope, mapping=cast(dict[FieldT, EncodableT], value))
+                pipe.expire(scope, RESTAURANT_TTL)
+        with REDIS_SECONDS.time(operation="store_payload"):
+            await pipe.execute()
+
+
+async def menus_to_refresh(
+    key: str, refetch: Callable[[RestaurantMenu], bool], location: Location | None
+) -> tuple[list[str], dict[str, RestaurantMenu], list[str]]:
+    names, menus = await load_menus(key)
+    refresh = [
+        parser.name
+        for parser in restaurant_parsers(location)
+        if parser.name not in menus or refetch(menus[parser.name])
+    ]
+    return names, menus, refresh
+
+
+async def refresh_menus(
+    key: str, refetch: Callable[[RestaurantMenu], bool], location: Location | None = None, slot: str | None = None
+) -> bool:
+    lock_key = f"{key}.refreshing"
+    token = secrets.token_hex(16)
+    while True:
+        names, menus, refresh = await menus_to_refresh(key, refetch, location)
+        if not refresh and await redis_client.exists(payload_key(key, location)):
+            # nothing to fetch, taking the lock would just make the others wait and report their payloads as stale
+            if slot:
+                await redis_client.set(slot, 1, nx=True, ex=RESTAURANT_TTL)
+            return True
+        if await redis_client.set(lock_key, token, nx=True, ex=REFRESH_TIMEOUT):
+            break
+        # another worker is already refreshing, its result is ours too unless it built the payload of another location
+        await wait_for_refresh(key)
+        if await redis_client.exists(payload_key(key, location)):
+            return False
+
+    written = False
+    try:
+        # the prefetch slot is taken only by the worker holding the lock, so it can't be lost to a busy lock
+        if slot and not await redis_client.set(slot, 1, nx=True, ex=RESTAURANT_TTL):
+            return True
+
+        # the menus might have been refreshed by another worker before we got the lock
+        names, menus, refresh = await menus_to_refresh(key, refetch, location)
+        if not refresh and await redis_client.exists(payload_key(key, location)):
+            return True
+
+        fetched: list[RestaurantMenu] = []
+        if refresh:
+            # cached payloads are served as fresh, so the workers drop them and see the refresh in Redis
+            await redis_client.publish(f"{key}.refreshing", 1)
+            # failures are counted across all the workers and days, the refresh lock keeps them consistent
+            states = await redis_client.hmget("restaurants.circuits", refresh)
+            circuits = {
+                name: circuit_adapter.validate_json(state) for name, state in zip(refresh, states, strict=True) if state
+            }
+
+            async def store_fetched() -> None:
+                # store and announce every restaurant as soon as it is parsed for the streaming clients
+                async for menu in stream_restaurants(
+                    refresh, executor=parse_executor, client=restaurant_http, circuits=circuits
+                ):
+                    menus[menu.id] = menu
+                    fetched.append(menu)
+                    observe_menu(menu)
+                    data = restaurant_adapter.dump_json(menu)
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        pipe.set(f"{key}.restaurant.{menu.id}", data, ex=RESTAURANT_TTL)
+                        pipe.hset("restaurants.circuits", menu.id, circuit_adapter.dump_json(circuits[menu.id]))
+                        pipe.hincrby(f"{key}.polls", menu.id, 1)
+                        pipe.publish(f"{key}.restaurant", data)
+                        with REDIS_SECONDS.time(operation="store_menu"):
+                            await pipe.execute()
+
+            storing = asyncio.create_task(store_fetched())
+            await asyncio.wait([storing], timeout=REFRESH_DEADLINE)
+            if not storing.done():
+                # serve what is done by now, the payloads are written again once the slow restaurants finish
+                done = {menu.id for menu in fetched}
+                partial = menus | {
+                    name: dataclasses.replace(menus[name], pending=True)
+                    if name in menus
+                    else lunches.pending_menu(name, lunches.PAGE_CACHE, REFRESH_DEADLINE)
+                    for name in refresh
+                    if name not in done
+                }
+                fetch_count = int(await redis_client.get(f"{key}.fetch_count") or 0)
+                await store_payloads(key, names, partial, fetch_count, location)
+                await redis_client.publish(f"{key}.refreshed", 1)
+            await storing
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.expire(f"{key}.polls", RESTAURANT_TTL)
+                pipe.incr(f"{key}.fetch_count")
+                fetch_count = (await pipe.execute())[-1]
+        else:
+            fetch_count = int(await redis_client.get(f"{key}.fetch_count") or 0)
+
+        await store_payloads(key, names, menus, fetch_count, location)
+        written = True
+
+        try:
+            await asyncio.to_thread(archive.store, datetime.datetime.now(TZ).date(), fetched)
+        except Exception:
+            LOGGER.exception("Archiving menus failed")
+        return True
+    finally:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.eval(RELEASE_LOCK, 1, lock_key, token)
+            if written:
+                pipe.publish(f"{key}.refreshed", 1)
+            await pipe.execute()
+
+
+async def refresh_requested(
+    key: str, requested: set[str], location: Location | None, running: asyncio.Task[bool] | None
+) -> bool:
+    # a refresh started by someone else refetches by their rules, so ours follows it
+    try:
+        if running:
+            await asyncio.wait([running])
+    finally:
+        # requests from now on queue another refresh, this one fetches the restaurants asked for so far
+        queued_refreshes.pop(payload_key(key, location), None)
+
     now = int(datetime.datetime.now(TZ).timestamp())
-    key = f"restaurants.{datetime.datetime.now(TZ).strftime('%d-%m-%Y')}"
-    result_raw = await redis_client.get(key)
-    if not result_raw or request.method == "POST":
-        throttle_key = f"{key}.throttle"
-        if await redis_client.incr(throttle_key) != 1:
-            return ErrorResponse(error="Fetch limit reached. Try again later.")
-        await redis_client.expire(throttle_key, 60 * 3)
-
-        result = LunchResponse(
-            last_fetch=now,
-            fetch_count=await redis_client.incr(f"{key}.fetch_count"),
-            restaurants=list(await gather_restaurants()),
+    for _ in range(REFRESH_ATTEMPTS):
+        if await refresh_menus(key, lambda menu: needs_refresh(menu, now) or menu.id in requested, location):
+            return True
+    return False
+
+
+def track_refresh(scope: str, task: asyncio.Task[bool]) -> asyncio.Task[bool]:
+    def finished(_: asyncio.Task[bool]) -> None:
+        if refreshes.get(scope) is task:
+            del refreshes[scope]
+
+    refreshes[scope] = task
+    task.add_done_callback(finished)
+    return task
+
+
+def start_refresh(
+    key: str, refetch: Callable[[RestaurantMenu], bool], location: Location | None = None
+) -> asyncio.Task[bool]:
+    # concurrent requests in this worker share the running refresh
+    scope = payload_key(key, location)
+    if scope in refreshes:
+        return refreshes[scope]
+    return track_refresh(scope, asyncio.create_task(refresh_menus(key, refetch, location)))
+
+
+def request_refresh(key: str, restaurants: set[str], location: Location | None = None) -> asyncio.Task[bool]:
+    # a burst of requests asking for restaurants of their own shares a single refresh queued after the running one
+    scope = payload_key(key, location)
+    if scope in queued_refreshes:
+        requested, task = queued_refreshes[scope]
+        requested |= restaurants
+        return task
+    requested = set(restaurants)
+    task = asyncio.create_task(refresh_requested(key, requested, location, refreshes.get(scope)))
+    queued_refreshes[scope] = (requested, task)
+    return track_refresh(scope, task)
+
+
+async def prefetch(now: datetime.datetime) -> None:
+    if now.weekday() >= 5 or not PREFETCH_PLAN[0] <= now.time() <= PREFETCH_UNTIL:
+        return
+
+    key = day_key(now)
+    timestamp = int(now.timestamp())
+    slot = max(t for t in PREFETCH_PLAN if t <= now.time())
+    slot_key = f"{key}.prefetch.{slot.isoformat('minutes')}"
+    if not await redis_client.exists(slot_key):
+        # retried on the next tick when another worker holds the lock
+        await refresh_menus(key, lambda menu: needs_refresh(menu, timestamp), slot=slot_key)
+        return
+
+    polls = cast(dict[bytes, bytes], await redis_client.hgetall(f"{key}.polls"))
+
+    def repoll(menu: RestaurantMenu) -> bool:
+        count = int(polls.get(menu.id.encode(), 1))
+        if not awaiting_menu(menu) or count > len(REPOLL_BACKOFF):
+            return False
+        return timestamp - menu.last_fetch >= REPOLL_BACKOFF[count - 1]
+
+    await refresh_menus(key, repoll)
+
+
+async def prefetch_scheduler() -> None:
+    if not PREFETCH_PLAN:
+        return
+    while True:
+        try:
+            await prefetch(datetime.datetime.now(TZ))
+        except Exception:
+            LOGGER.exception("Prefetch failed")
+        await asyncio.sleep(PREFETCH_TICK)
+
+
+async def flush_visits() -> None:
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+        try:
+            await visits.flush(redis_client)
+        except Exception:
+            LOGGER.exception("Flushing visits failed")
+
+
+async def invalidate_payloads() -> None:
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.psubscribe("restaurants.*.refreshing", "restaurants.*.refreshed")
+                # notifications might have been missed while not subscribed
+                payload_cache.clear()
+                async for message in pubsub.listen():
+                    if message["type"] == "pmessage":
+                        key = message["channel"].decode().rsplit(".", 1)[0]
+                        for scope in [scope for scope in payload_cache if scope.startswith(f"{key}.")]:
+                            del payload_cache[scope]
+        except Exception:
+            LOGGER.exception("Listening for refreshes failed")
+        await asyncio.sleep(1)
+
+
+def filter_payload(
+    location: Location | None, payload: dict[bytes, bytes], query: str | None, since: int | None
+) -> dict[bytes, bytes]:
+    parsed = parsed_payloads.get(location)
+    if not parsed or parsed.etag != payload[b"etag"]:
+        result = LunchResponse.model_validate_json(payload[b"identity"])
+        parsed = parsed_payloads[location] = ParsedPayload(
+            payload[b"etag"], result, menu_index.build(result.restaurants), json.loads(payload.get(b"versions", b"{}"))
         )
-        await redis_client.set(key, pickle.dumps(result))
+
+    restaurants = parsed.result.restaurants
+    if query:
+        matches = parsed.index.search(query)
+        restaurants = [menu for menu in restaurants if menu.id in matches]
+    # a version from the future means redis lost the counter, the client gets everything again
+    if since is not None and since > parsed.result.version:
+        since = None
+    if since is not None:
+        restaurants = [menu for menu in restaurants if parsed.versions.get(menu.id, parsed.result.version) > since]
+
+    filtered = parsed.result.model_copy(update={"restaurants": restaurants, "since": since})
+    # encoded just for this request, brotli is too slow for that
+    return encode_payload(filtered, ("gzip",))
+
+
+@app.get("/lunch.index.json", response_model=menu_index.MenuIndex)
+async def lunch_index(request: Request, location: Location | None = None) -> Response:
+    # built with the /lunch.json payload of the same location, so the client can search it by token
+    scope = payload_key(day_key(datetime.datetime.now(TZ)), location, "index")
+    cached = payload_cache.get(scope)
+    if cached and cached[0] > time.monotonic():
+        payload = cached[1]
     else:
-        result = pickle.loads(cast(bytes, result_raw))
+        with REDIS_SECONDS.time(operation="load_index"):
+            payload = cast(dict[bytes, bytes], await redis_client.hgetall(scope))
+        if payload:
+            payload_cache[scope] = (time.monotonic() + PAYLOAD_CACHE_TTL, payload)
+    return payload_response(request, payload or encode_payload(menu_index.MenuIndex()), {})
 
-    disallow_nets = [
-        ipaddress.ip_network(net)
-        for net in ["127.0.0.0/8", "::1/128", "192.168.1.0/24", "89.103.137.232/32", "2001:470:5816::/48"]
-    ]
-    for net in disallow_nets:
-        if net.version == 4:
-            disallow_nets.append(ipaddress.ip_network(f"::ffff:{net.network_address}/{96 + net.prefixlen}"))
 
+@app.get("/lunch.json", response_model=LunchResponse)
+@app.post("/lunch.json", response_model=LunchResponse)
+async def lunch(
+    request: Request,
+    restaurant: Annotated[list[str] | None, Query()] = None,
+    location: Location | None = None,
+    q: str | None = None,
+    since: Annotated[int | None, Query(ge=0, description="version the client already has")] = None,
+) -> Response:
+    now = int(datetime.datetime.now(TZ).timestamp())
+    key = day_key(datetime.datetime.now(TZ))
+
+    scope = payload_key(key, location)
     if request.client:
-        visitor_addr = ipaddress.ip_address(request.client.host)
-        if not any(net for net in disallow_nets if visitor_addr in net):
-            await asyncio.gather(
-                redis_client.incr(f"{key}.access_count"), redis_client.setnx(f"{key}.first_access", now)
-            )
-
-    async def get_stat(k: str) -> int:
-        val = await redis_client.get(f"{key}.{k}")
-        if val:
-            return int(val)
+        visits.record(key, request.client.host, now)
+
+    cached = payload_cache.get(scope)
+    totals = visits.totals.get(key)
+    if cached and cached[0] > time.monotonic() and totals and request.method == "GET":
+        # answered from the worker memory, refreshes elsewhere drop the cached payload when they start and end
+        payload = cached[1]
+        refreshing = scope in refreshes
+        CACHE_REQUESTS.inc(result="local")
+    else:
+        # the payload and access statistics are read in a single round trip, visits are written in batches
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(scope)
+            pipe.exists(f"{key}.refreshing")
+            pipe.get(f"{key}.access_count")
+            pipe.get(f"{key}.first_access")
+            pipe.pfcount(f"{key}.visitors")
+            with REDIS_SECONDS.time(operation="load_payload"):
+                payload, refreshing, access_count, first_access, unique_visitors = await pipe.execute()
+        payload = cast(dict[bytes, bytes], payload)
+        totals = analytics.DayStats(int(access_count or 0), int(first_access or 0), unique_visitors)
+        visits.totals[key] = totals
+        if payload and not refreshing:
+            payload_cache[scope] = (time.monotonic() + PAYLOAD_CACHE_TTL, payload)
+        CACHE_REQUESTS.inc(result="hit" if payload else "miss")
+    unflushed = visits.unflushed(key)
+
+    # serve what we have and let the client poll again while the menus are refreshed in the background
+    if not payload or request.method == "POST":
+        if request.method == "POST":
+            refresh = request_refresh(key, set(restaurant or []), location)
         else:
-            return 0
+            refresh = start_refresh(key, lambda menu: False, location)
+        refreshing = True
+
+        if not payload:
+            # nothing to serve yet, all concurrent visitors wait for the single running refresh
+            payload = await wait_for_payload(key, location, refresh)
+            refreshing = not refresh.done() or not payload
+    if not payload:
+        payload = encode_payloads([], {}, 0)[location][0]
+    if q or since is not None:
+        payload = filter_payload(location, payload, q, since)
+
+    return payload_response(
+        request,
+        payload,
+        {
+            "X-Access-Count": str(totals.count + unflushed.count),
+            "X-First-Access": str(totals.first_access or unflushed.first_access),
+            "X-Unique-Visitors": str(totals.unique_visitors + visits.new_visitors(key)),
+            "X-Stale": "1" if refreshing else "0",
+        },
+    )
+
+
+@app.get("/lunch.ndjson")
+@app.post("/lunch.ndjson")
+async def lunch_stream(
+    request: Request,
+    restaurant: Annotated[list[str] | None, Query()] = None,
+    location: Location | None = None,
+) -> StreamingResponse:
+    key = day_key(datetime.datetime.now(TZ))
+
+    async def lines() -> AsyncIterator[bytes]:
+        async with redis_client.pubsub() as pubsub:
+            await pubsub.subscribe(f"{key}.restaurant")
+            if request.method == "POST":
+                refresh = request_refresh(key, set(restaurant or []), location)
+            else:
+                refresh = start_refresh(key, lambda menu: False, location)
+
+            # cached restaurants go first, fetched ones follow as they finish and replace them by their id
+            names, menus = await load_menus(key)
+            for name in names:
+                if name in menus and location in (None, menus[name].location):
+                    yield restaurant_adapter.dump_json(menus[name]) + b"\n"
 
-    result.access_count, result.first_access = await asyncio.gather(get_stat("access_count"), get_stat("first_access"))
+            while True:
+                finished = refresh.done()
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if message and location in (None, restaurant_adapter.validate_json(message["data"]).location):
+                    yield message["data"] + b"\n"
+                elif finished:
+                    break
 
-    return result
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
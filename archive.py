@@ -0,0 +1,128 @@
+import datetime
+import os
+import sqlite3
+from collections.abc import Iterable
+from contextlib import closing
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from lunches import Lunch, RestaurantMenu, Soup
+from menu_index import fold
+
+ARCHIVE_PATH = Path(os.getenv("ARCHIVE_PATH", Path.home() / ".local" / "share" / "lunchmenu" / "archive.sqlite"))
+ARCHIVE_RETENTION_DAYS = int(os.getenv("ARCHIVE_RETENTION_DAYS", str(5 * 365)))
+
+# the full-text index shares rows with dishes and ignores diacritics, so "svickova" finds "Svíčková"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dishes (
+    id INTEGER PRIMARY KEY,
+    day TEXT NOT NULL,
+    restaurant TEXT NOT NULL,
+    title TEXT NOT NULL,
+    soup INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    folded TEXT NOT NULL,
+    price INTEGER
+);
+CREATE INDEX IF NOT EXISTS dishes_day ON dishes (day, restaurant);
+CREATE VIRTUAL TABLE IF NOT EXISTS dishes_fts USING fts5(
+    name, content='dishes', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS dishes_insert AFTER INSERT ON dishes BEGIN
+    INSERT INTO dishes_fts (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS dishes_delete AFTER DELETE ON dishes BEGIN
+    INSERT INTO dishes_fts (dishes_fts, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+"""
+
+
+class DishStats(BaseModel):
+    restaurant: str
+    title: str
+    name: str
+    first_seen: datetime.date
+    last_seen: datetime.date
+    days: int
+    min_price: int | None
+    avg_price: float | None
+    max_price: int | None
+
+
+def init(path: Path = ARCHIVE_PATH) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with closing(sqlite3.connect(path, timeout=30)) as db:
+        # several workers archive into the same file, the journal mode stays set in it
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+
+
+def store(day: datetime.date, menus: Iterable[RestaurantMenu], path: Path = ARCHIVE_PATH) -> None:
+    rows = []
+    archived = []
+    for menu in menus:
+        if menu.error or not (menu.soups or menu.lunches):
+            continue
+        archived.append((day.isoformat(), menu.id))
+        foods: list[Soup | Lunch] = [*menu.soups, *menu.lunches]
+        for food in foods:
+            rows.append(
+                (
+                    day.isoformat(),
+                    menu.id,
+                    menu.name,
+                    isinstance(food, Soup),
+                    food.name,
+                    fold(food.name),
+                    food.price if isinstance(food.price, int) else None,
+                )
+            )
+
+    oldest = day - datetime.timedelta(days=ARCHIVE_RETENTION_DAYS)
+    with closing(sqlite3.connect(path, timeout=30)) as db, db:
+        db.execute("DELETE FROM dishes WHERE day < ?", (oldest.isoformat(),))
+        # menus change during the day, the last version wins
+        db.executemany("DELETE FROM dishes WHERE day = ? AND restaurant = ?", archived)
+        db.executemany(
+            "INSERT INTO dishes (day, restaurant, title, soup, name, folded, price) VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+
+def search(query: str, restaurant: str | None = None, limit: int = 20, path: Path = ARCHIVE_PATH) -> list[DishStats]:
+    # every word has to match the start of a word in the dish, quoted so user input is never fts syntax
+    words = query.replace('"', " ").split()
+    if not words:
+        return []
+    match = " ".join(f'"{word}"*' for word in words)
+
+    sql = """
+        SELECT d.restaurant, d.title, d.name, MIN(d.day), MAX(d.day), COUNT(DISTINCT d.day),
+            MIN(d.price), AVG(d.price), MAX(d.price)
+        FROM dishes_fts JOIN dishes d ON d.id = dishes_fts.rowid
+        WHERE dishes_fts MATCH ?
+    """
+    params: list[str | int] = [match]
+    if restaurant:
+        sql += " AND d.restaurant = ?"
+        params.append(restaurant)
+    sql += " GROUP BY d.restaurant, d.folded ORDER BY MAX(d.day) DESC, COUNT(*) DESC LIMIT ?"
+    params.append(limit)
+
+    if not path.exists():
+        return []
+    with closing(sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True, timeout=30)) as db:
+        return [
+            DishStats(
+                restaurant=row[0],
+                title=row[1],
+                name=row[2],
+                first_seen=row[3],
+                last_seen=row[4],
+                days=row[5],
+                min_price=row[6],
+                avg_price=row[7],
+                max_price=row[8],
+            )
+            for row in db.execute(sql, params)
+        ]
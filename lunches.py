@@ -1,19 +1,26 @@
 #!/usr/bin/env -S uv run --script
 import asyncio
+import contextlib
+import dataclasses
 import datetime
+import functools
+import hashlib
 import json
 import logging
+import os
 import re
 import string
 import sys
 import time
 import traceback
 import types
-from collections.abc import AsyncGenerator, Callable, Generator, Iterable
+from collections.abc import AsyncGenerator, Callable, Coroutine, Generator, Iterable
+from concurrent.futures import Executor
 from dataclasses import dataclass, field
 from enum import StrEnum
 from html import unescape
-from typing import Any
+from pathlib import Path
+from typing import Any, cast
 from zoneinfo import ZoneInfo
 
 import httpx
@@ -22,6 +29,14 @@ from selectolax.parser import HTMLParser, Node, Selector
 days = ["Pondělí", "Úterý", "Středa", "Čtvrtek", "Pátek", "Sobota", "Neděle"]
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/105.0.0.0 Safari/537.36"
 TZ = ZoneInfo("Europe/Prague")
+# most of the restaurants are served from menicka.cz, don't hammer it with all requests at once
+HOST_CONCURRENCY = {"www.menicka.cz": 4}
+DEFAULT_HOST_CONCURRENCY = 8
+HTTP_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+    keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30")),
+)
 LOGGER = logging.getLogger(__name__)
 
 
@@ -54,12 +69,20 @@ class RestaurantMenu:
     name: str
     url: str
     location: Location
+    id: str = ""
+    last_fetch: int = 0
     elapsed: float = 0
+    elapsed_queue: float = 0
     elapsed_html_request: float = 0
     elapsed_parsing: float = 0
+    elapsed_cleanup: float = 0
     soups: list[Soup] = field(default_factory=list)
     lunches: list[Lunch] = field(default_factory=list)
     error: str | None = None
+    failures: int = 0
+    circuit_open: bool = False
+    # not finished within the deadline, the menu is the last cached one or empty
+    pending: bool = False
 
 
 Foods = Generator[Soup | Lunch] | AsyncGenerator[Soup | Lunch]
@@ -93,11 +116,11 @@ def restaurant(title: str, url: str, location: Location) -> Callable[..., Restau
     return wrapper
 
 
-def menicka_parser(dom: Node) -> Generator[Soup | Lunch]:
-    current_day = datetime.datetime.now(TZ).strftime("%-d.%-m.%Y")
+def menicka_parser(dom: Node, day: datetime.date) -> Generator[Soup | Lunch]:
+    current_day = day.strftime("%-d.%-m.%Y")
     for day_dom in dom.css(".content"):
-        day = day_dom.css("h2")[0].text(strip=True).split(maxsplit=2)[1]
-        if current_day not in day:
+        title = day_dom.css("h2")[0].text(strip=True).split(maxsplit=2)[1]
+        if current_day not in title:
             continue
 
         soup_el = day_dom.css_first(".soup .food")
@@ -119,9 +142,91 @@ def menicka_parser(dom: Node) -> Generator[Soup | Lunch]:
             )
 
 
-async def subprocess_check_output(cmd: list[str], input: bytes) -> str:
+async def subprocess_check_output(cmd: list[str], input: bytes, timeout: float | None = None) -> str:
     p = await asyncio.create_subprocess_exec(*cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
-    return (await p.communicate(input))[0].decode("utf-8")
+    try:
+        return (await asyncio.wait_for(p.communicate(input), timeout))[0].decode("utf-8")
+    except TimeoutError:
+        p.kill()
+        await p.wait()
+        raise
+
+
+def conditional_headers(etag: str | None, last_modified: str | None) -> dict[str, str]:
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+@dataclass
+class CachedImage:
+    content_hash: str
+    etag: str | None = None
+    last_modified: str | None = None
+    # the recognized text, reused without asking the server for the days of a week parsed from the same image
+    lang: str | None = None
+    text: str = ""
+    checked: float = 0
+
+
+# menu images change about once a week, so their text is kept on disk by the image hash
+OCR_CACHE_DIR = Path(os.getenv("OCR_CACHE_DIR", Path.home() / ".cache" / "lunchmenu" / "ocr"))
+OCR_CACHE_SIZE = 64
+OCR_TIMEOUT = 60
+OCR_RECHECK = 60
+OCR_SLOTS = asyncio.Semaphore(int(os.getenv("OCR_WORKERS", "2")))
+OCR_IMAGES: dict[str, CachedImage] = {}
+
+
+def store_ocr_text(path: Path, text: str) -> None:
+    OCR_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+    for old in sorted(OCR_CACHE_DIR.iterdir(), key=lambda p: p.stat().st_mtime, reverse=True)[OCR_CACHE_SIZE:]:
+        old.unlink(missing_ok=True)
+
+
+async def ocr(http: httpx.AsyncClient, url: str, lang: str = "ces") -> str:
+    cached = OCR_IMAGES.get(url)
+    if cached and cached.lang == lang and time.time() - cached.checked < OCR_RECHECK:
+        return cached.text
+
+    response = await http.get(url, headers=conditional_headers(cached.etag, cached.last_modified) if cached else None)
+    if cached and response.status_code == 304:
+        path = OCR_CACHE_DIR / f"{cached.content_hash}-{lang}.txt"
+        if path.exists():
+            path.touch()
+            cached.lang, cached.text, cached.checked = lang, path.read_text(), time.time()
+            return cached.text
+        # our cache file is gone, but the server still has the same image
+        response = await http.get(url)
+
+    response.raise_for_status()
+    if not response.content:
+        return ""
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    path = OCR_CACHE_DIR / f"{content_hash}-{lang}.txt"
+    if path.exists():
+        path.touch()
+        text = path.read_text()
+    else:
+        async with OCR_SLOTS:
+            text = await subprocess_check_output(
+                ["tesseract", "-l", lang, "--psm", "4", "-", "-"], response.content, timeout=OCR_TIMEOUT
+            )
+        await asyncio.to_thread(store_ocr_text, path, text)
+
+    OCR_IMAGES[url] = CachedImage(
+        content_hash,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        lang=lang,
+        text=text,
+        checked=time.time(),
+    )
+    return text
 
 
 @restaurant("Bistro IN", "https://bistroin.choiceqr.com/delivery", Location.Poruba)
@@ -143,8 +248,8 @@ def bistroin(dom: Node) -> Foods:
 
 
 @restaurant("U jarosu", "https://www.ujarosu.cz/cz/denni-menu/", Location.Poruba)
-def u_jarosu(dom: Node) -> Foods:
-    today = datetime.datetime.strftime(datetime.datetime.now(TZ), "%d. %m. %Y")
+def u_jarosu(dom: Node, day: datetime.date) -> Foods:
+    today = day.strftime("%d. %m. %Y")
     for row in dom.css(".celyden"):
         parsed_day = row.css(".datum")[0].text()
         if parsed_day == today:
@@ -214,8 +319,8 @@ def jacks_burger(dom: Node) -> Foods:
 
 
 @restaurant("Poklad", "https://www.menicka.cz/api/iframe/?id=8217", Location.Poruba)
-def poklad(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def poklad(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Trebovicky mlyn", "https://www.trebovickymlyn.cz/denni-menu/", Location.Poruba)
@@ -237,10 +342,10 @@ def trebovicky_mlyn(dom: Node) -> Foods:
 
 
 @restaurant("Trebovicka role", "https://trebovickarole.cz/denni-menu/", Location.Poruba)
-def trebovicka_role(dom: Node) -> Foods:
+def trebovicka_role(dom: Node, day: datetime.date) -> Foods:
     MENU_REGEXP = re.compile(r"Menu (?P<num>[0-9])\s*:\s*(?P<name>.+)")
 
-    day_nth = datetime.datetime.now(TZ).weekday()
+    day_nth = day.weekday()
     for h4 in dom.css("h4"):
         if days[day_nth] in h4.text():
             table = h4.next
@@ -262,8 +367,8 @@ def trebovicka_role(dom: Node) -> Foods:
 
 
 @restaurant("La Strada", "https://www.lastrada.cz/cz/?tpl=plugins/DailyMenu/print&week_shift=", Location.Poruba)
-def lastrada(dom: Node) -> Foods:
-    day_nth = datetime.datetime.now(TZ).weekday()
+def lastrada(dom: Node, day: datetime.date) -> Foods:
+    day_nth = day.weekday()
 
     capturing = False
     for tr in dom.css("tr"):
@@ -277,8 +382,8 @@ def lastrada(dom: Node) -> Foods:
 
 
 @restaurant("Ellas", "https://www.restauraceellas.cz/", Location.Poruba)
-def ellas(dom: Node) -> Foods:
-    day_nth = datetime.datetime.now(TZ).weekday()
+def ellas(dom: Node, day: datetime.date) -> Foods:
+    day_nth = day.weekday()
     lunch_pattern = re.compile(r"(?P<name>.*?)\s*(\(([^)]+)\))?\s*(–|-)\s*(?P<price>[0-9]+),-")
 
     capturing = False
@@ -346,18 +451,18 @@ def plzenka(dom: Node) -> Foods:
 
 
 @restaurant("El Amigo Muerto", "https://www.menicka.cz/api/iframe/?id=5560", Location.Poruba)
-def el_amigo_muerto(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def el_amigo_muerto(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("John’s Ribs Bistro", "https://www.menicka.cz/api/iframe/?id=9398", Location.Poruba)
-def johns_ribs_bistro(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def johns_ribs_bistro(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Rusty Bell Pub", "https://www.menicka.cz/api/iframe/?id=1547", Location.Poruba)
-def rusty_bell_pub(dom: Node) -> Foods:
-    foods = list(menicka_parser(dom))
+def rusty_bell_pub(dom: Node, day: datetime.date) -> Foods:
+    foods = list(menicka_parser(dom, day))
     if not foods:
         return None
     yield Soup(foods[1].name)
@@ -386,8 +491,8 @@ def viktorka(dom: Node) -> Foods:
 
 
 @restaurant("Futrovna", "https://www.menicka.cz/api/iframe/?id=7200", Location.Poruba)
-def futrovna(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def futrovna(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Kurnik sopa", "https://www.kurniksopahospoda.cz", Location.Poruba)
@@ -458,27 +563,26 @@ def lafutura(dom: Node) -> Foods:
 
 
 @restaurant("Srub", "https://www.menicka.cz/api/iframe/?id=5568", Location.Dubina)
-def srub(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def srub(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("U formana", "https://www.menicka.cz/api/iframe/?id=4405", Location.Dubina)
-def uformana(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def uformana(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Maston", "https://maston.cz/jidelni-listek/", Location.Dubina)
-async def maston(dom: Node, http: httpx.AsyncClient) -> Foods:
+async def maston(dom: Node, http: httpx.AsyncClient, day: datetime.date) -> Foods:
     srcs = dom.css(".attachment-large")[0].attrs["srcset"]
     if not srcs:
         return
     img_url = srcs.split(",")[-1].strip().split(" ")[0]
 
-    img = (await http.get(img_url)).content
-    text = await subprocess_check_output(["tesseract", "-l", "ces", "--psm", "4", "-", "-"], img)
+    text = await ocr(http, img_url)
 
-    today = datetime.datetime.strftime(datetime.datetime.now(TZ), "%-d%-m")
-    tomorrow = datetime.datetime.strftime(datetime.datetime.now(TZ) + datetime.timedelta(days=1), "%-d%-m")
+    today = day.strftime("%-d%-m")
+    tomorrow = (day + datetime.timedelta(days=1)).strftime("%-d%-m")
     capturing = False
     for line in text.splitlines():
         txt = line.replace(" ", "").replace(".", "")
@@ -496,23 +600,23 @@ async def maston(dom: Node, http: httpx.AsyncClient) -> Foods:
 
 
 @restaurant("Kozlovna U Ježka", "https://www.menicka.cz/api/iframe/?id=5122", Location.Dubina)
-def kozlovna(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def kozlovna(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Fontána", "https://www.menicka.cz/api/iframe/?id=1456", Location.Dubina)
-def fontana(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def fontana(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("U Vojty", "https://www.menicka.cz/api/iframe/?id=7857", Location.Vitkovice)
-def u_vojty(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def u_vojty(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("U Prokopa", "https://www.menicka.cz/api/iframe/?id=1506", Location.Vitkovice)
-def u_prokopa(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def u_prokopa(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Gulliver", "https://www.gastropetr.cz/index.php?go=TydenniMenu", Location.Vitkovice)
@@ -527,46 +631,46 @@ def gulliver(dom: Node) -> Foods:
 
 
 @restaurant("Veronika", "https://www.menicka.cz/api/iframe/?id=2232", Location.Vitkovice)
-def veronika(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def veronika(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Burger & Beer Brothers", "https://www.menicka.cz/api/iframe/?id=7863", Location.Olomouc)
-def bbbrothers(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def bbbrothers(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Café Restaurant Caesar", "https://www.menicka.cz/api/iframe/?id=5293", Location.Olomouc)
-def caesar(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def caesar(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Morgans restaurant", "https://www.menicka.cz/api/iframe/?id=5294", Location.Olomouc)
-def morgans(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def morgans(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("U Mořice", "https://www.menicka.cz/api/iframe/?id=5299", Location.Olomouc)
-def moric(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def moric(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Kikiriki", "https://www.menicka.cz/api/iframe/?id=5309", Location.Olomouc)
-def kikiriki(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def kikiriki(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("U Kristýna", "https://www.menicka.cz/api/iframe/?id=5471", Location.Olomouc)
-def kristyn(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def kristyn(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Bistro Paulus", "https://www.bistro-paulus.cz/poledni-menu/", Location.Olomouc)
-def paulus(dom: Node) -> Foods:
-    current_day = datetime.datetime.now(TZ).strftime("%-d.%-m.%Y")
+def paulus(dom: Node, day: datetime.date) -> Foods:
+    current_day = day.strftime("%-d.%-m.%Y")
     for day_dom in dom.css(".section-day"):
-        day = "".join(day_dom.css("h3")[0].text(strip=True).split()[1:])
-        if current_day not in day:
+        title = "".join(day_dom.css("h3")[0].text(strip=True).split()[1:])
+        if current_day not in title:
             continue
 
         soup_table = day_dom.css("table")[0].css("span")
@@ -579,63 +683,63 @@ def paulus(dom: Node) -> Foods:
 
 
 @restaurant("Slezska P.U.O.R", "https://www.menicka.cz/api/iframe/?id=1406", Location.Centrum)
-def puor(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def puor(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Kanteen", "https://www.menicka.cz/api/iframe/?id=8684", Location.Centrum)
-def kanteen(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def kanteen(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Pizza Coloseum Karolina", "https://www.menicka.cz/api/iframe/?id=517", Location.Centrum)
-def coloseum(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def coloseum(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Eatnam", "https://www.menicka.cz/api/iframe/?id=9416", Location.Centrum)
-def eatnam(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def eatnam(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Restaurace Platan", "https://www.menicka.cz/api/iframe/?id=1421", Location.Centrum)
-def platan(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def platan(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("IQ Restaurant", "https://www.menicka.cz/api/iframe/?id=1401", Location.Centrum)
-def iq(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def iq(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Mustang", "https://www.menicka.cz/api/iframe/?id=6389", Location.Centrum)
-def mustang(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def mustang(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Coal&Fire", "https://www.menicka.cz/api/iframe/?id=3486", Location.Centrum)
-def coalandfire(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def coalandfire(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Ostrawica Lokál", "https://www.menicka.cz/api/iframe/?id=8648", Location.Centrum)
-def ostravica_lokal(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def ostravica_lokal(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("4 z Tanku", "https://www.menicka.cz/api/iframe/?id=8855", Location.Centrum)
-def ztanku(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def ztanku(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Burfi", "https://www.menicka.cz/api/iframe/?id=4134", Location.Centrum)
-def burfi(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def burfi(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
 
 
 @restaurant("Makalu", "https://www.nepalska-restaurace-makalu.cz/MAKALU/PAGES/OSTRAVA/Weekly.php", Location.Centrum)
-def namaste_ostrava(dom: Node) -> Foods:
-    day_nth = datetime.datetime.now(TZ).weekday()
+def namaste_ostrava(dom: Node, day: datetime.date) -> Foods:
+    day_nth = day.weekday()
     if day_nth > 4:  # Skip Sat/Sun
         return None
 
@@ -693,8 +797,19 @@ def namaste_ostrava(dom: Node) -> Foods:
 
 
 @restaurant("Frankie's Pub", "https://www.menicka.cz/api/iframe/?id=7080", Location.Centrum)
-def frankies_pub(dom: Node) -> Foods:
-    yield from menicka_parser(dom)
+def frankies_pub(dom: Node, day: datetime.date) -> Foods:
+    yield from menicka_parser(dom, day)
+
+
+# built once all the parsers above are defined
+RESTAURANTS = {obj.name: obj for obj in list(globals().values()) if isinstance(obj, RestaurantParser)}
+RESTAURANTS_BY_LOCATION = {loc: [p for p in RESTAURANTS.values() if p.location == loc] for loc in Location}
+
+
+def restaurant_parsers(location: Location | None = None) -> list[RestaurantParser]:
+    if location is None:
+        return list(RESTAURANTS.values())
+    return RESTAURANTS_BY_LOCATION[location]
 
 
 def fix_price(price: int | str | None) -> int | None:
@@ -711,129 +826,505 @@ def fix_price(price: int | str | None) -> int | None:
     return None
 
 
-async def gather_restaurants(allowed_restaurants: list[str] | None = None) -> list[RestaurantMenu]:
-    replacements = [
-        (re.compile(r"^\s*(Polévka|BUSINESS MENU|business|SALÁT TÝDNE|tip týdne)", re.IGNORECASE), ""),
-        (re.compile(r"(k menu|K POLEDNÍMU MENU ZDARMA)\s*$"), ""),
-        (re.compile(r"(s|š|S|Š)vestk"), "Trnk"),
-        # remove price
-        (re.compile(r"(\d+)\s*kč", re.IGNORECASE), ""),
-        # remove multiple commas
-        (re.compile(r"(\s*,)+"), ","),
-        # ugly space before comma or colon
-        (re.compile(r"\s*(,|:)\s*"), "\\1 "),
-        # HTML tags
-        (re.compile(r"<[^<]+?>"), ""),
-        # grammage
-        (re.compile(r"\d+\s*(g|ml|l|ks)( |,)"), ""),
-        # remove leftover alergen 'A:1,2,3'
-        (re.compile(r"A:\s*\d(\s*,\s*\d+,)*"), ""),
-        # alergens pattern 'Al ('
-        (re.compile(r"\s*A?l?\.?\s*\("), "("),
-        # alergens as a numbers: 1, 2, 3
-        (re.compile(r"[0-9]+(\s*,\s*[0-9]+)+"), ""),
-        # brackets
-        (re.compile(r"\([^)]+\)"), ""),
-        # multiple white-spaces
-        (re.compile(r"\s+"), " "),
-    ]
-    UPPER_REGEXP = re.compile(r"[A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ]")
-
-    def detect_encoding(text: bytes) -> str:
-        if b"windows-1250" in text:
-            return "windows-1250"
-        return "utf-8"
-
-    transport = httpx.AsyncHTTPTransport(retries=3)
-    client = httpx.AsyncClient(
+SOUP_PREFIX_REGEXP = re.compile(r"^\s*(Polévka|BUSINESS MENU|business|SALÁT TÝDNE|tip týdne)", re.IGNORECASE)
+MENU_SUFFIX_REGEXP = re.compile(r"(k menu|K POLEDNÍMU MENU ZDARMA)\s*$")
+PLUM_REGEXP = re.compile(r"(s|š|S|Š)vestk")
+PRICE_REGEXP = re.compile(r"(\d+)\s*kč", re.IGNORECASE)
+# multiple commas and ugly spaces around commas or colons,
+# the lookaheads just make the regex engine skip positions which can't start a match quickly
+SEPARATOR_REGEXP = re.compile(r"(?=[\s,:])(?:(?:\s*,)+\s*|\s*:\s*)")
+HTML_TAG_REGEXP = re.compile(r"<[^<]+?>")
+GRAMMAGE_REGEXP = re.compile(r"\d+\s*(g|ml|l|ks)( |,)")
+# leftover alergen 'A:1,2,3'
+ALERGEN_LABEL_REGEXP = re.compile(r"A:\s*\d(\s*,\s*\d+,)*")
+# alergens pattern 'Al ('
+ALERGEN_BRACKET_REGEXP = re.compile(r"(?=[\sAl.(])\s*A?l?\.?\s*\(")
+# alergens as a numbers: 1, 2, 3
+ALERGEN_NUMBERS_REGEXP = re.compile(r"[0-9]+(\s*,\s*[0-9]+)+")
+BRACKETS_REGEXP = re.compile(r"\([^)]+\)")
+UPPER_CHARS = str.maketrans("", "", "ABCDEFGHIJKLMNOPQRSTUVWXYZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ")
+NAME_STRIP_CHARS = string.punctuation + string.whitespace + string.digits + "„–—\xa0"
+
+
+def separator(match: re.Match[str]) -> str:
+    return ", " if "," in match.group() else ": "
+
+
+@functools.lru_cache(maxsize=8192)
+def normalize_name(name: str) -> str:
+    # the same dishes repeat across days and restaurants, most of the patterns are skipped
+    # by a cheap substring check when they can't match at all
+    name = unescape(name)
+    name = SOUP_PREFIX_REGEXP.sub("", name)
+    if "k menu" in name or "ZDARMA" in name:
+        name = MENU_SUFFIX_REGEXP.sub("", name)
+    if "vestk" in name:
+        name = PLUM_REGEXP.sub("Trnk", name)
+    if "č" in name or "Č" in name:
+        name = PRICE_REGEXP.sub("", name)
+    if "," in name or ":" in name:
+        name = SEPARATOR_REGEXP.sub(separator, name)
+    if "<" in name:
+        name = HTML_TAG_REGEXP.sub("", name)
+    name = GRAMMAGE_REGEXP.sub("", name)
+    if "A:" in name:
+        name = ALERGEN_LABEL_REGEXP.sub("", name)
+    if "(" in name:
+        name = ALERGEN_BRACKET_REGEXP.sub("(", name)
+    if "," in name:
+        name = ALERGEN_NUMBERS_REGEXP.sub("", name)
+    if "(" in name:
+        name = BRACKETS_REGEXP.sub("", name)
+    name = " ".join(name.split()).strip(NAME_STRIP_CHARS)
+    uppers = len(name) - len(name.translate(UPPER_CHARS))
+    if uppers > len(name) / 2:
+        name = name.lower()
+        name = name.capitalize()
+    return name
+
+
+def cleanup(menu: RestaurantMenu) -> None:
+    for soup in menu.soups:
+        soup.price = fix_price(soup.price)
+        soup.name = normalize_name(soup.name)
+
+    num = 0
+    for food in menu.lunches:
+        food.price = fix_price(food.price)
+        food.name = normalize_name(food.name)
+        if food.ingredients:
+            food.ingredients = normalize_name(food.ingredients)
+
+        if isinstance(food.num, str):
+            try:
+                food.num = int(food.num.replace(".", ""))
+            except ValueError:
+                LOGGER.warning("Failed to parse lunch position: %s", food.num)
+                food.num = None
+        if not food.num:
+            food.num = num + 1
+        num = food.num
+
+
+ParserArgs = dict[str, Node | httpx.AsyncClient | str | datetime.date]
+ParsedDay = tuple[list[Soup], list[Lunch], float]
+
+
+def page_args(parser: RestaurantParser, text: str) -> ParserArgs:
+    args: ParserArgs = {}
+    if "res" in parser.args:
+        args["res"] = text
+    elif "dom" in parser.args:
+        dom = HTMLParser(text)
+        if dom.root:
+            args["dom"] = dom.root
+    return args
+
+
+def add_items(menu: RestaurantMenu, items: Iterable[Soup | Lunch]) -> None:
+    for item in items:
+        if isinstance(item, Soup):
+            menu.soups.append(item)
+        elif isinstance(item, Lunch):
+            menu.lunches.append(item)
+        else:
+            raise NotImplementedError("Unsupported item")
+
+
+async def materialize(parser: RestaurantParser, args: ParserArgs) -> list[Soup | Lunch]:
+    parsed = parser.parse_fn(**args)
+    if isinstance(parsed, types.AsyncGeneratorType):
+        return [i async for i in parsed]
+    elif isinstance(parsed, Iterable):
+        return list(parsed)
+    return []
+
+
+def week_days(today: datetime.date) -> list[datetime.date]:
+    monday = today - datetime.timedelta(days=today.weekday())
+    return [monday + datetime.timedelta(days=i) for i in range(7)]
+
+
+def clean_day(parser: RestaurantParser, items: Iterable[Soup | Lunch]) -> ParsedDay:
+    menu = RestaurantMenu(name=parser.title, url=parser.url, location=parser.location, id=parser.name)
+    add_items(menu, items)
+    start = time.time()
+    cleanup(menu)
+    return menu.soups, menu.lunches, time.time() - start
+
+
+# parsers taking the day get the whole week at once, a broken menu of another day than today is just skipped
+async def parse_days(
+    parser: RestaurantParser, args: ParserArgs, days: list[datetime.date | None], today: datetime.date
+) -> list[ParsedDay | None]:
+    parsed: list[ParsedDay | None] = []
+    for day in days:
+        if day:
+            args["day"] = day
+        try:
+            parsed.append(clean_day(parser, await materialize(parser, args)))
+        except Exception:
+            if day in (None, today):
+                raise
+            parsed.append(None)
+    return parsed
+
+
+def parse_page(
+    name: str, content: bytes, encoding: str, days: list[datetime.date | None], today: datetime.date
+) -> list[ParsedDay | None]:
+    # runs in a worker process, so only the page and the parsed foods are sent over
+    parser = RESTAURANTS[name]
+    args = page_args(parser, content.decode(encoding, errors="replace"))
+    return asyncio.run(parse_days(parser, args, days, today))
+
+
+@dataclass
+class CachedPage:
+    content_hash: str
+    # parsed menus by the ISO date, weekly pages hold every day of the week
+    menus: dict[str, RestaurantMenu] = field(default_factory=dict)
+    etag: str | None = None
+    last_modified: str | None = None
+    checked: float = 0
+
+    def validators(self) -> dict[str, str]:
+        return conditional_headers(self.etag, self.last_modified)
+
+
+# parsed pages of today or this week, reused while the restaurant serves the same content
+PAGE_CACHE: dict[str, CachedPage] = {}
+# weekly pages are checked for changes again after seconds
+WEEKLY_RECHECK = int(os.getenv("WEEKLY_RECHECK", str(3 * 60 * 60)))
+# fetches that missed the deadline and keep filling the page cache
+BACKGROUND_FETCHES: set[asyncio.Task[None]] = set()
+
+CIRCUIT_THRESHOLD = int(os.getenv("CIRCUIT_THRESHOLD", "5"))
+CIRCUIT_PROBE_INTERVAL = int(os.getenv("CIRCUIT_PROBE_INTERVAL", "3600"))
+# where the command line keeps the circuits between runs
+CIRCUIT_STATE = Path(os.getenv("CIRCUIT_STATE", Path.home() / ".cache" / "lunchmenu" / "circuits.json"))
+
+
+@dataclass
+class Circuit:
+    failures: int = 0
+    last_error: str | None = None
+    last_attempt: float = 0
+
+    @property
+    def open(self) -> bool:
+        return self.failures >= CIRCUIT_THRESHOLD
+
+    def attempt(self, now: float) -> bool:
+        # an open circuit lets through a single probe once in a while
+        if self.open and now - self.last_attempt < CIRCUIT_PROBE_INTERVAL:
+            return False
+        self.last_attempt = now
+        return True
+
+    def record(self, error: str | None) -> None:
+        self.failures = self.failures + 1 if error else 0
+        self.last_error = error
+
+
+# consecutive failures of each restaurant, kept across refreshes
+CIRCUITS: dict[str, Circuit] = {}
+
+
+def load_circuits(path: Path = CIRCUIT_STATE) -> dict[str, Circuit]:
+    try:
+        return {name: Circuit(**state) for name, state in json.loads(path.read_text()).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_circuits(circuits: dict[str, Circuit], path: Path = CIRCUIT_STATE) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps({name: dataclasses.asdict(circuit) for name, circuit in circuits.items()}))
+
+
+@dataclass
+class FetchResult:
+    response: httpx.Response
+    elapsed_queue: float
+    elapsed_request: float
+
+
+class FetchScheduler:
+    def __init__(self, client: httpx.AsyncClient, host_concurrency: dict[str, int] | None = None) -> None:
+        self.client = client
+        self.host_concurrency = HOST_CONCURRENCY if host_concurrency is None else host_concurrency
+        self.slots: dict[str, asyncio.Semaphore] = {}
+        self.inflight: dict[tuple[str, frozenset[tuple[str, str]]], asyncio.Future[FetchResult]] = {}
+
+    def slot(self, host: str) -> asyncio.Semaphore:
+        if host not in self.slots:
+            self.slots[host] = asyncio.Semaphore(self.host_concurrency.get(host, DEFAULT_HOST_CONCURRENCY))
+        return self.slots[host]
+
+    async def fetch(self, url: str, headers: dict[str, str]) -> FetchResult:
+        start = time.time()
+        async with self.slot(httpx.URL(url).host):
+            queued = time.time() - start
+            response = await self.client.get(url, headers=headers)
+            return FetchResult(response, elapsed_queue=queued, elapsed_request=time.time() - start - queued)
+
+    async def get(self, url: str, headers: dict[str, str] | None = None) -> FetchResult:
+        headers = headers or {}
+        # restaurants sharing the same page are downloaded just once
+        key = (url, frozenset(headers.items()))
+        if key not in self.inflight:
+            self.inflight[key] = asyncio.ensure_future(self.fetch(url, headers))
+        return await asyncio.shield(self.inflight[key])
+
+
+def detect_encoding(text: bytes) -> str:
+    if b"windows-1250" in text:
+        return "windows-1250"
+    return "utf-8"
+
+
+def recording_path(directory: Path, request: httpx.Request) -> Path:
+    return directory / hashlib.sha256(f"{request.method} {request.url}".encode()).hexdigest()[:16]
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    # saves raw responses, so they can be served by replay_transport() without network
+    def __init__(self, directory: Path, transport: httpx.AsyncBaseTransport) -> None:
+        self.directory = directory
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        content = b"".join([chunk async for chunk in cast(httpx.AsyncByteStream, response.stream)])
+        await response.aclose()
+
+        path = recording_path(self.directory, request)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path.with_suffix(".body").write_bytes(content)
+        meta = {"url": str(request.url), "status": response.status_code, "headers": response.headers.multi_items()}
+        path.with_suffix(".json").write_text(json.dumps(meta, ensure_ascii=False, indent=2))
+        return httpx.Response(response.status_code, headers=response.headers, content=content, request=request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def replay_transport(directory: Path) -> httpx.MockTransport:
+    def handler(request: httpx.Request) -> httpx.Response:
+        path = recording_path(directory, request)
+        if not path.with_suffix(".json").exists():
+            return httpx.Response(404, text=f"{request.url} was not recorded")
+        meta = json.loads(path.with_suffix(".json").read_text())
+        return httpx.Response(
+            meta["status"], headers=[tuple(h) for h in meta["headers"]], content=path.with_suffix(".body").read_bytes()
+        )
+
+    return httpx.MockTransport(handler)
+
+
+def http_transport(limits: httpx.Limits = HTTP_LIMITS) -> httpx.AsyncHTTPTransport:
+    return httpx.AsyncHTTPTransport(retries=3, http2=True, limits=limits)
+
+
+def create_client(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    if transport is None:
+        transport = http_transport()
+    return httpx.AsyncClient(
         default_encoding=detect_encoding, headers={"User-Agent": USER_AGENT}, timeout=10, transport=transport
     )
 
-    def cleanup(menu: RestaurantMenu) -> None:
-        def fix_name(name: str) -> str:
-            name = unescape(name)
-            for pattern, replacement in replacements:
-                name = pattern.sub(replacement, name)
-            name = name.strip(string.punctuation + string.whitespace + string.digits + "„–—\xa0")
-            uppers = len(UPPER_REGEXP.findall(name))
-            if uppers > len(name) / 2:
-                name = name.lower()
-                name = name.capitalize()
-            return name
-
-        for soup in menu.soups:
-            soup.price = fix_price(soup.price)
-            soup.name = fix_name(soup.name)
-
-        num = 0
-        for food in menu.lunches:
-            food.price = fix_price(food.price)
-            food.name = fix_name(food.name)
-            if food.ingredients:
-                food.ingredients = fix_name(food.ingredients)
-
-            if isinstance(food.num, str):
-                try:
-                    food.num = int(food.num.replace(".", ""))
-                except ValueError:
-                    LOGGER.warning("Failed to parse lunch position: %s", food.num)
-                    food.num = None
-            if not food.num:
-                food.num = num + 1
-            num = food.num
+
+def collect_restaurants(
+    client: httpx.AsyncClient,
+    allowed_restaurants: list[str] | None = None,
+    page_cache: dict[str, CachedPage] | None = None,
+    executor: Executor | None = None,
+    circuits: dict[str, Circuit] | None = None,
+) -> dict[str, Coroutine[Any, Any, RestaurantMenu]]:
+    scheduler = FetchScheduler(client)
+    if page_cache is None:
+        page_cache = PAGE_CACHE
+    if circuits is None:
+        circuits = CIRCUITS
 
     async def collect(parser: RestaurantParser) -> RestaurantMenu:
+        circuit = circuits.setdefault(parser.name, Circuit())
+        if not circuit.attempt(time.time()):
+            return RestaurantMenu(
+                name=parser.title,
+                url=parser.url,
+                location=parser.location,
+                id=parser.name,
+                last_fetch=int(circuit.last_attempt),
+                error=circuit.last_error,
+                failures=circuit.failures,
+                circuit_open=True,
+            )
+        res = await fetch_menu(parser)
+        circuit.record(res.error)
+        res.failures = circuit.failures
+        res.circuit_open = circuit.open
+        return res
+
+    async def fetch_menu(parser: RestaurantParser) -> RestaurantMenu:
         start = time.time()
         res = RestaurantMenu(
             name=parser.title,
             url=parser.url,
             location=parser.location,
+            id=parser.name,
+            last_fetch=int(start),
         )
+        today = datetime.datetime.now(TZ).date()
+        weekly = "day" in parser.args
+        days: list[datetime.date | None] = list(week_days(today)) if weekly else [None]
+        cached = page_cache.get(parser.name)
+        if cached and today.isoformat() not in cached.menus:
+            cached = None
+
+        def from_cache(cached: CachedPage, queue: float = 0, request: float = 0) -> RestaurantMenu:
+            return dataclasses.replace(
+                cached.menus[today.isoformat()],
+                last_fetch=res.last_fetch,
+                elapsed=time.time() - start,
+                elapsed_queue=queue,
+                elapsed_html_request=request,
+                elapsed_parsing=0,
+                elapsed_cleanup=0,
+            )
+
+        if weekly and cached and start - cached.checked < WEEKLY_RECHECK:
+            menu = cached.menus[today.isoformat()]
+            if menu.soups or menu.lunches:
+                return from_cache(cached)
+
+        page: CachedPage | None = None
         try:
-            args: dict[str, Node | httpx.AsyncClient | str] = {}
+            response: httpx.Response | None = None
             if "res" in parser.args or "dom" in parser.args:
-                response = await client.get(parser.url)
-                if "res" in parser.args:
-                    args["res"] = response.text
-                elif "dom" in parser.args:
-                    dom = HTMLParser(response.text)
-                    if dom.root:
-                        args["dom"] = dom.root
-            if "http" in parser.args:
-                args["http"] = client
-            html_request_time = time.time() - start
+                fetched = await scheduler.get(parser.url, cached.validators() if cached else None)
+                res.elapsed_queue = fetched.elapsed_queue
+                response = fetched.response
+                page = CachedPage(
+                    content_hash=hashlib.sha256(response.content).hexdigest(),
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                    checked=start,
+                )
+                if cached and (response.status_code == 304 or page.content_hash == cached.content_hash):
+                    cached.checked = start
+                    return from_cache(cached, fetched.elapsed_queue, fetched.elapsed_request)
+            html_request_time = time.time() - start - res.elapsed_queue
             start = time.time()
 
-            async def materialize() -> list[Soup | Lunch]:
-                parsed = parser.parse_fn(**args)
-                if isinstance(parsed, types.AsyncGeneratorType):
-                    return [i async for i in parsed]
-                elif isinstance(parsed, Iterable):
-                    return list(parsed)
-                return []
-
-            for item in await materialize() or []:
-                if isinstance(item, Soup):
-                    res.soups.append(item)
-                elif isinstance(item, Lunch):
-                    res.lunches.append(item)
-                else:
-                    raise NotImplementedError("Unsupported item")
+            if executor and response and "http" not in parser.args:
+                parsed = await asyncio.get_running_loop().run_in_executor(
+                    executor, parse_page, parser.name, response.content, response.encoding or "utf-8", days, today
+                )
+            else:
+                args = page_args(parser, response.text) if response else {}
+                if "http" in parser.args:
+                    args["http"] = client
+                parsed = await parse_days(parser, args, days, today)
+            parsed_today = parsed[days.index(today) if weekly else 0]
+            if parsed_today:
+                res.soups, res.lunches, _ = parsed_today
+            else:
+                res.error = "Menu of today was not parsed"
+            res.elapsed_cleanup = sum(p[2] for p in parsed if p)
             match_time = time.time() - start
-            res.elapsed = html_request_time + match_time
+            res.elapsed = res.elapsed_queue + html_request_time + match_time
             res.elapsed_html_request = html_request_time
-            res.elapsed_parsing = match_time
-            cleanup(res)
+            res.elapsed_parsing = match_time - res.elapsed_cleanup
+            if page:
+                for day, p in zip(days, parsed, strict=True):
+                    if p:
+                        page.menus[(day or today).isoformat()] = dataclasses.replace(res, soups=p[0], lunches=p[1])
+                page_cache[parser.name] = page
+        except asyncio.CancelledError:
+            # not finished in time is not a failure of the restaurant
+            raise
         except:  # noqa: E722
             res.error = traceback.format_exc()
             res.elapsed = time.time() - start
         return res
 
-    restaurants = [obj for _, obj in globals().items() if isinstance(obj, RestaurantParser)]
     if not allowed_restaurants:
-        allowed_restaurants = [r.name for r in restaurants]
-
-    return await asyncio.gather(*[collect(r) for r in restaurants if r.name in allowed_restaurants])
+        allowed_restaurants = list(RESTAURANTS)
+    return {name: collect(RESTAURANTS[name]) for name in allowed_restaurants if name in RESTAURANTS}
+
+
+def pending_menu(name: str, page_cache: dict[str, CachedPage], elapsed: float) -> RestaurantMenu:
+    parser = RESTAURANTS[name]
+    cached = page_cache.get(name)
+    today = datetime.datetime.now(TZ).date().isoformat()
+    if cached and today in cached.menus:
+        menu = dataclasses.replace(cached.menus[today])
+    else:
+        menu = RestaurantMenu(name=parser.title, url=parser.url, location=parser.location, id=parser.name)
+    menu.elapsed = elapsed
+    menu.pending = True
+    return menu
+
+
+async def finish_in_background(tasks: list[asyncio.Task[RestaurantMenu]], stack: contextlib.AsyncExitStack) -> None:
+    async with stack:
+        await asyncio.wait(tasks)
+
+
+async def gather_restaurants(
+    allowed_restaurants: list[str] | None = None,
+    page_cache: dict[str, CachedPage] | None = None,
+    executor: Executor | None = None,
+    client: httpx.AsyncClient | None = None,
+    deadline: float | None = None,
+    background: bool = True,
+    circuits: dict[str, Circuit] | None = None,
+) -> list[RestaurantMenu]:
+    if page_cache is None:
+        page_cache = PAGE_CACHE
+    async with contextlib.AsyncExitStack() as stack:
+        if client is None:
+            client = await stack.enter_async_context(create_client())
+        collectors = collect_restaurants(client, allowed_restaurants, page_cache, executor, circuits)
+        if deadline is None:
+            return await asyncio.gather(*collectors.values())
+
+        tasks = {name: asyncio.ensure_future(c) for name, c in collectors.items()}
+        if tasks:
+            await asyncio.wait(tasks.values(), timeout=deadline)
+        late = [t for t in tasks.values() if not t.done()]
+        if late and not background:
+            # nobody would use their results, so they are not left to be cancelled at exit
+            for task in late:
+                task.cancel()
+            await asyncio.wait(late)
+        elif late:
+            # the client is closed only after the late restaurants are done
+            finisher = asyncio.create_task(finish_in_background(late, stack.pop_all()))
+            BACKGROUND_FETCHES.add(finisher)
+            finisher.add_done_callback(BACKGROUND_FETCHES.discard)
+        return [
+            t.result() if t.done() and not t.cancelled() else pending_menu(name, page_cache, deadline)
+            for name, t in tasks.items()
+        ]
+
+
+async def stream_restaurants(
+    allowed_restaurants: list[str] | None = None,
+    page_cache: dict[str, CachedPage] | None = None,
+    executor: Executor | None = None,
+    client: httpx.AsyncClient | None = None,
+    circuits: dict[str, Circuit] | None = None,
+) -> AsyncGenerator[RestaurantMenu]:
+    async with contextlib.AsyncExitStack() as stack:
+        if client is None:
+            client = await stack.enter_async_context(create_client())
+        for menu in asyncio.as_completed(
+            collect_restaurants(client, allowed_restaurants, page_cache, executor, circuits).values()
+        ):
+            yield await menu
 
 
 if __name__ == "__main__":
@@ -841,23 +1332,61 @@ if __name__ == "__main__":
 
     p = argparse.ArgumentParser()
     p.add_argument("restaurant", nargs="*")
+    p.add_argument("--location", "-l", type=Location, choices=list(Location), help="only restaurants in this location")
     p.add_argument("--sort", "-s", choices=["error", "time", "alphabet"], default="error")
+    p.add_argument("--jobs", "-j", type=int, default=0, help="parse pages in this many processes")
+    p.add_argument("--deadline", "-d", type=float, help="report restaurants not fetched within seconds as pending")
+    recording = p.add_mutually_exclusive_group()
+    recording.add_argument("--record", type=Path, help="save all responses to this directory")
+    recording.add_argument("--replay", type=Path, help="serve responses saved by --record instead of network")
     args = p.parse_args()
+    if args.location:
+        args.restaurant += [r.name for r in restaurant_parsers(args.location)]
 
     logging.basicConfig(format="[%(asctime)s] %(levelname)s %(name)s - %(message)s", level=logging.INFO)
 
-    restaurants = asyncio.run(gather_restaurants(args.restaurant))
+    transport: httpx.AsyncBaseTransport | None = None
+    if args.replay:
+        transport = replay_transport(args.replay)
+    elif args.record:
+        transport = RecordingTransport(args.record, http_transport())
+
+    # replayed responses would teach the circuits nothing about the real restaurants
+    circuits = {} if args.replay else load_circuits()
+
+    async def run(executor: Executor | None = None) -> list[RestaurantMenu]:
+        async with create_client(transport) as client:
+            return await gather_restaurants(
+                args.restaurant,
+                executor=executor,
+                client=client,
+                deadline=args.deadline,
+                background=False,
+                circuits=circuits,
+            )
+
+    if args.jobs:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(args.jobs) as executor:
+            restaurants = asyncio.run(run(executor))
+    else:
+        restaurants = asyncio.run(run())
+    if not args.replay:
+        save_circuits(circuits)
 
     sorters = {
         "time": lambda r: r.elapsed,
-        "error": lambda r: (r.error is not None, len(r.lunches) == 0),
+        "error": lambda r: (r.error is not None, r.circuit_open, r.failures, len(r.lunches) == 0),
         "alphabet": lambda r: r.name,
     }
 
     exit_code = 0
     for rest in sorted(restaurants, key=sorters[args.sort]):
         print()
-        print(rest.name, f"({rest.elapsed:.3}s)")
+        print(rest.name, f"({rest.elapsed:.3}s{', pending' if rest.pending else ''})")
+        if rest.failures:
+            print(f"  failed {rest.failures}x in a row" + (", circuit open" if rest.circuit_open else ""))
         if rest.error:
             if "httpx.ConnectError" not in rest.error and "httpx.ConnectTimeout" not in rest.error:
                 exit_code = 1
@@ -0,0 +1,62 @@
+import bisect
+import functools
+import re
+import unicodedata
+from collections.abc import Iterable
+
+from pydantic import BaseModel
+
+from lunches import Lunch, RestaurantMenu, Soup
+
+WORD_REGEXP = re.compile(r"\w+")
+# position of the restaurant name in the postings, foods are numbered from 0 with the soups first
+NAME = -1
+
+
+def fold(text: str) -> str:
+    decomposed = unicodedata.normalize("NFD", text.lower())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+
+def words(text: str) -> list[str]:
+    return WORD_REGEXP.findall(fold(text))
+
+
+class MenuIndex(BaseModel):
+    # folded word -> restaurant id -> positions of the foods containing it
+    tokens: dict[str, dict[str, list[int]]] = {}
+
+    @functools.cached_property
+    def sorted_tokens(self) -> list[str]:
+        return sorted(self.tokens)
+
+    def search(self, query: str) -> dict[str, set[int]]:
+        # restaurants where every query word starts some word, with the positions of the matching foods
+        matches: dict[str, set[int]] | None = None
+        for word in words(query):
+            found: dict[str, set[int]] = {}
+            i = bisect.bisect_left(self.sorted_tokens, word)
+            while i < len(self.sorted_tokens) and self.sorted_tokens[i].startswith(word):
+                for restaurant, positions in self.tokens[self.sorted_tokens[i]].items():
+                    found.setdefault(restaurant, set()).update(positions)
+                i += 1
+            if matches is None:
+                matches = found
+            else:
+                matches = {
+                    restaurant: positions | found[restaurant]
+                    for restaurant, positions in matches.items()
+                    if restaurant in found
+                }
+        return matches or {}
+
+
+def build(menus: Iterable[RestaurantMenu]) -> MenuIndex:
+    tokens: dict[str, dict[str, list[int]]] = {}
+    for menu in menus:
+        foods: list[Soup | Lunch] = [*menu.soups, *menu.lunches]
+        names = [(NAME, menu.name), *enumerate(food.name for food in foods)]
+        for position, name in names:
+            for word in dict.fromkeys(words(name)):
+                tokens.setdefault(word, {}).setdefault(menu.id, []).append(position)
+    return MenuIndex(tokens=dict(sorted(tokens.items())))
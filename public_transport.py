@@ -1,15 +1,32 @@
 #!/usr/bin/env -S uv run --script
 import asyncio
+import contextlib
 import datetime
+import heapq
 import itertools
+import logging
+import os
 from time import time
 from zoneinfo import ZoneInfo
 
 import httpx
-from pydantic import BaseModel
+import redis.asyncio as redis
+from pydantic import BaseModel, TypeAdapter
 from selectolax.parser import HTMLParser, Node
 
 TZ = ZoneInfo("Europe/Prague")
+# connections are looked up again every minute
+CACHE_TTL = 60
+# a worker fetching a search holds a lock so the others wait for its result, polling the cache
+FETCH_LOCK_TTL = 10
+FETCH_POLL = 0.1
+# IDOS is a single host, so it gets a pool of its own instead of the one for all the restaurants
+IDOS_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("IDOS_MAX_CONNECTIONS", "10")),
+    max_keepalive_connections=int(os.getenv("IDOS_MAX_KEEPALIVE_CONNECTIONS", "10")),
+    keepalive_expiry=float(os.getenv("IDOS_KEEPALIVE_EXPIRY", "60")),
+)
+LOGGER = logging.getLogger(__name__)
 
 
 class Station(BaseModel):
@@ -28,52 +45,144 @@ class Link(BaseModel):
     connections: list[Connection]
 
 
-async def public_transport_connections(sources: list[str], destinations: list[str]) -> list[Link]:
-    async def fetch(http: httpx.AsyncClient, source: str, destination: str) -> list[Link]:
-        url = f"https://idos.cz/odis/spojeni/vysledky/?f={source}&fc=303003&t={destination}&tc=303003"
-        start = time()
-        links = []
-        resp = await http.get(url)
-        print(f"{url} took {time() - start} sec")
-        dom = HTMLParser(resp.text)
-
-        for node in dom.css(".connection.box"):
-            total = node.css(".total strong")[0].text()
-            if "hod" in total:
-                continue
-
-            connections = []
-            for a in node.css(".outside-of-popup"):
-
-                def to_datetime(s: str) -> datetime.datetime:
-                    date = datetime.datetime.now(TZ)
-                    hour, minute = s.split(":")
-                    return date.replace(hour=int(hour), minute=int(minute), second=0)
-
-                def p(node: Node) -> Station:
-                    return Station(
-                        time=to_datetime(node.css(".time")[0].text()),
-                        station=node.css(".station strong")[0].text(),
-                    )
-
-                connections.append(
-                    Connection(
-                        link=a.css(".line-title h3")[0].text(),
-                        from_=p(a.css(".stations .item")[0]),
-                        to=p(a.css(".stations .item")[1]),
-                    )
+links_adapter = TypeAdapter(list[Link])
+LINKS_CACHE: dict[tuple[str, str, int], list[Link]] = {}
+LINKS_INFLIGHT: dict[tuple[str, str, int], asyncio.Future[list[Link]]] = {}
+
+
+def create_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(http2=True, timeout=10, limits=IDOS_LIMITS)
+
+
+async def fetch_links(http: httpx.AsyncClient, source: str, destination: str) -> list[Link]:
+    url = f"https://idos.cz/odis/spojeni/vysledky/?f={source}&fc=303003&t={destination}&tc=303003"
+    start = time()
+    links = []
+    resp = await http.get(url)
+    LOGGER.info("%s took %.3f sec", url, time() - start)
+    dom = HTMLParser(resp.text)
+
+    for node in dom.css(".connection.box"):
+        total = node.css(".total strong")[0].text()
+        if "hod" in total:
+            continue
+
+        connections = []
+        for a in node.css(".outside-of-popup"):
+
+            def to_datetime(s: str) -> datetime.datetime:
+                date = datetime.datetime.now(TZ)
+                hour, minute = s.split(":")
+                return date.replace(hour=int(hour), minute=int(minute), second=0, microsecond=0)
+
+            def p(node: Node) -> Station:
+                return Station(
+                    time=to_datetime(node.css(".time")[0].text()),
+                    station=node.css(".station strong")[0].text(),
                 )
 
-            links.append(Link(total=int(total.split(" ")[0]), connections=connections))
+            connections.append(
+                Connection(
+                    link=a.css(".line-title h3")[0].text(),
+                    from_=p(a.css(".stations .item")[0]),
+                    to=p(a.css(".stations .item")[1]),
+                )
+            )
+
+        links.append(Link(total=int(total.split(" ")[0]), connections=connections))
+    return links
+
+
+async def shared_links(redis_client: redis.Redis, redis_key: str) -> list[Link] | None:
+    # returns None when we hold the fetching lock, other workers then wait for our result instead of asking IDOS too
+    try:
+        for _ in range(int(FETCH_LOCK_TTL / FETCH_POLL)):
+            if cached := await redis_client.get(redis_key):
+                return links_adapter.validate_json(cached)
+            if await redis_client.set(f"{redis_key}.fetching", 1, nx=True, ex=FETCH_LOCK_TTL):
+                return None
+            await asyncio.sleep(FETCH_POLL)
+    except redis.RedisError:
+        LOGGER.warning("Redis is unavailable, fetching %s directly", redis_key, exc_info=True)
+    return None
+
+
+async def cached_links(
+    http: httpx.AsyncClient, source: str, destination: str, redis_client: redis.Redis | None
+) -> list[Link]:
+    minute = int(time() // 60)
+    key = (source, destination, minute)
+    if key in LINKS_CACHE:
+        return LINKS_CACHE[key]
+
+    async def load() -> list[Link]:
+        redis_key = f"idos.{source}.{destination}.{minute}"
+        links = await shared_links(redis_client, redis_key) if redis_client else None
+        if links is None:
+            try:
+                links = await fetch_links(http, source, destination)
+            finally:
+                if redis_client:
+                    try:
+                        async with redis_client.pipeline() as pipe:
+                            if links is not None:
+                                pipe.set(redis_key, links_adapter.dump_json(links), ex=CACHE_TTL)
+                            pipe.delete(f"{redis_key}.fetching")
+                            await pipe.execute()
+                    except redis.RedisError:
+                        LOGGER.warning("Storing %s failed", redis_key, exc_info=True)
+
+        for old in [k for k in LINKS_CACHE if k[2] < minute]:
+            del LINKS_CACHE[old]
+        LINKS_CACHE[key] = links
         return links
 
-    searches = list(itertools.product(sources, destinations))
-    async with httpx.AsyncClient() as http:
-        results = await asyncio.gather(*[fetch(http, *s) for s in searches])
-        all_links = list(itertools.chain(*results))
+    # visitors asking at the same time share a single request
+    if key not in LINKS_INFLIGHT:
+        LINKS_INFLIGHT[key] = asyncio.ensure_future(load())
+        LINKS_INFLIGHT[key].add_done_callback(lambda _: LINKS_INFLIGHT.pop(key, None))
+    return await asyncio.shield(LINKS_INFLIGHT[key])
+
 
-    all_links.sort(key=lambda i: (i.connections[-1].to.time, i.total))
-    return all_links
+def trip_key(link: Link) -> tuple[tuple[str, datetime.datetime, str], ...]:
+    # the same vehicles boarded at the same stops, no matter where we get off
+    return tuple((c.link, c.from_.time, c.from_.station) for c in link.connections)
+
+
+async def public_transport_connections(
+    sources: list[str],
+    destinations: list[str],
+    http: httpx.AsyncClient | None = None,
+    redis_client: redis.Redis | None = None,
+    window: datetime.timedelta | None = None,
+    limit: int | None = None,
+) -> list[Link]:
+    searches = list(itertools.product(sources, destinations))
+    async with contextlib.AsyncExitStack() as stack:
+        if http is None:
+            http = await stack.enter_async_context(create_client())
+        results = await asyncio.gather(*[cached_links(http, *s, redis_client) for s in searches])
+
+    # among the same trips reached at several stops the earliest arrival wins
+    def order(link: Link) -> tuple[datetime.datetime, datetime.datetime]:
+        return link.connections[0].from_.time, link.connections[-1].to.time
+
+    # results are cached for a minute, so drop the connections that already left
+    now = datetime.datetime.now(TZ).replace(second=0, microsecond=0)
+    seen = set()
+    links = []
+    # IDOS lists connections by departure already, sorting just settles the ties by arrival
+    for link in heapq.merge(*[sorted(r, key=order) for r in results], key=order):
+        departure = link.connections[0].from_.time
+        if window is not None and departure > now + window:
+            break
+        if departure < now or trip_key(link) in seen:
+            continue
+        seen.add(trip_key(link))
+        links.append(link)
+        if len(links) == limit:
+            break
+    return links
 
 
 if __name__ == "__main__":
@@ -0,0 +1,32 @@
+#!/usr/bin/env -S uv run --script
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(Path(__file__).parent))
+
+from test_normalizer import corpus, reference_fix_name
+
+from lunches import normalize_name
+
+if __name__ == "__main__":
+    names = corpus()
+    rounds = 200
+
+    def cold() -> None:
+        normalize_name.cache_clear()
+        for name in names:
+            normalize_name(name)
+
+    def warm() -> None:
+        for name in names:
+            normalize_name(name)
+
+    def reference() -> None:
+        for name in names:
+            reference_fix_name(name)
+
+    for label, fn in [("reference", reference), ("normalize_name", cold), ("normalize_name cached", warm)]:
+        elapsed = min(timeit.repeat(fn, number=rounds, repeat=5)) / rounds / len(names)
+        print(f"{label:25} {elapsed * 1e6:8.2f} us/name")
@@ -0,0 +1,109 @@
+#!/usr/bin/env -S uv run --script
+import argparse
+import asyncio
+import copy
+import datetime
+import statistics
+import sys
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import httpx
+
+from lunches import (
+    CIRCUITS,
+    TZ,
+    RestaurantMenu,
+    RestaurantParser,
+    add_items,
+    cleanup,
+    create_client,
+    gather_restaurants,
+    materialize,
+    normalize_name,
+    page_args,
+    replay_transport,
+    restaurant_parsers,
+)
+
+
+async def bench_parser(client: httpx.AsyncClient, parser: RestaurantParser, rounds: int) -> tuple[float, float] | None:
+    text = ""
+    if "res" in parser.args or "dom" in parser.args:
+        response = await client.get(parser.url)
+        if response.status_code == 404:
+            return None
+        text = response.text
+
+    parse_times = []
+    cleanup_times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        args = page_args(parser, text)
+        if "http" in parser.args:
+            args["http"] = client
+        if "day" in parser.args:
+            args["day"] = datetime.datetime.now(TZ).date()
+        items = await materialize(parser, args)
+        parse_times.append(time.perf_counter() - start)
+
+        menu = RestaurantMenu(name=parser.title, url=parser.url, location=parser.location)
+        add_items(menu, copy.deepcopy(items))
+        normalize_name.cache_clear()
+        start = time.perf_counter()
+        cleanup(menu)
+        cleanup_times.append(time.perf_counter() - start)
+    return statistics.median(parse_times), statistics.median(cleanup_times)
+
+
+async def bench_gather(client: httpx.AsyncClient, rounds: int, executor: Executor | None) -> list[float]:
+    times = []
+    for _ in range(rounds):
+        CIRCUITS.clear()
+        normalize_name.cache_clear()
+        start = time.perf_counter()
+        await gather_restaurants(page_cache={}, executor=executor, client=client)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with create_client(replay_transport(args.recording)) as client:
+        print(f"{'restaurant':25} {'parse ms':>10} {'cleanup ms':>10}")
+        for parser in restaurant_parsers():
+            if args.restaurant and parser.name not in args.restaurant:
+                continue
+            try:
+                result = await bench_parser(client, parser, args.rounds)
+            except (httpx.HTTPError, LookupError, ValueError, AttributeError, TypeError) as e:
+                print(f"{parser.name:25} failed: {e!r}")
+                continue
+            if result is None:
+                print(f"{parser.name:25} {'not recorded':>21}")
+                continue
+            parse_time, cleanup_time = result
+            print(f"{parser.name:25} {parse_time * 1e3:10.3f} {cleanup_time * 1e3:10.3f}")
+
+        executor = ProcessPoolExecutor(args.jobs) if args.jobs else None
+        try:
+            times = await bench_gather(client, args.rounds, executor)
+        finally:
+            if executor:
+                executor.shutdown()
+        count = len(restaurant_parsers())
+        best = min(times)
+        print()
+        print(f"gather {count} restaurants: best {best * 1e3:.1f} ms, median {statistics.median(times) * 1e3:.1f} ms")
+        print(f"throughput {count / best:.1f} restaurants/s")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description="benchmark parsers on responses saved by lunches.py --record")
+    p.add_argument("recording", type=Path)
+    p.add_argument("restaurant", nargs="*")
+    p.add_argument("--rounds", "-n", type=int, default=20)
+    p.add_argument("--jobs", "-j", type=int, default=0, help="parse pages in this many processes during gather")
+    asyncio.run(main(p.parse_args()))
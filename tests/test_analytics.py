@@ -0,0 +1,44 @@
+import ipaddress
+
+import pytest
+
+from analytics import NetworkSet, Visits
+
+EXCLUDED = ["127.0.0.0/8", "::1/128", "192.168.1.0/24", "192.168.0.0/16", "2001:470:5816::/48"]
+
+
+@pytest.mark.parametrize(
+    ("addr", "excluded"),
+    [
+        ("127.0.0.5", True),
+        ("128.0.0.1", False),
+        ("::ffff:127.0.0.1", True),
+        ("::ffff:10.0.0.1", False),
+        ("::1", True),
+        ("::2", False),
+        ("2001:470:5816:1::5", True),
+        ("192.168.5.5", True),
+        ("192.169.0.0", False),
+        ("0.0.0.0", False),
+    ],
+)
+def test_network_set(addr: str, excluded: bool) -> None:
+    assert (ipaddress.ip_address(addr) in NetworkSet(EXCLUDED)) is excluded
+
+
+def test_visits_are_batched() -> None:
+    visits = Visits(NetworkSet(EXCLUDED), ttl=60)
+    assert visits.record("day", "10.0.0.1", 100)
+    assert visits.record("day", "10.0.0.1", 200)
+    assert visits.record("day", "10.0.0.2", 300)
+    assert not visits.record("day", "127.0.0.1", 400)
+    assert not visits.record("day", "testclient", 400)
+
+    day = visits.unflushed("day")
+    assert (day.count, day.first_access, day.visitors) == (3, 100, {"10.0.0.1", "10.0.0.2"})
+    assert visits.unflushed("other").count == 0
+    assert visits.new_visitors("day") == 2
+
+    # already counted by redis after an earlier flush
+    visits.flushed["day"] = {"10.0.0.1"}
+    assert visits.new_visitors("day") == 1
@@ -0,0 +1,27 @@
+import datetime
+from pathlib import Path
+
+import archive
+from lunches import Location, Lunch, RestaurantMenu, Soup
+
+
+def menu(soups: list[Soup], lunches: list[Lunch]) -> RestaurantMenu:
+    return RestaurantMenu("Bistro", "https://example.com", Location.Poruba, id="bistro", soups=soups, lunches=lunches)
+
+
+def test_search(tmp_path: Path) -> None:
+    db = tmp_path / "archive.sqlite"
+    assert archive.search("gulas", path=db) == []
+    archive.init(db)
+    monday, tuesday = datetime.date(2024, 3, 4), datetime.date(2024, 3, 5)
+    archive.store(monday, [menu([Soup("Gulášová")], [Lunch("Svíčková na smetaně", price=150)])], db)
+    archive.store(tuesday, [menu([], [Lunch("Svickova na smetane", price=160)])], db)
+    # refreshed later that day, the previous version is replaced
+    archive.store(tuesday, [menu([], [Lunch("Svíčková na smetaně", price=170)])], db)
+
+    [found] = archive.search("svickova smet", path=db)
+    assert (found.first_seen, found.last_seen, found.days) == (monday, tuesday, 2)
+    assert (found.min_price, found.avg_price, found.max_price) == (150, 160, 170)
+    assert archive.search("gulas", path=db)[0].days == 1
+    assert archive.search("gulas", restaurant="other", path=db) == []
+    assert archive.search('"', path=db) == []
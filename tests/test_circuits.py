@@ -0,0 +1,42 @@
+from pathlib import Path
+
+from lunches import CIRCUIT_PROBE_INTERVAL, CIRCUIT_THRESHOLD, Circuit, load_circuits, save_circuits
+
+
+def test_circuit_opens_after_failures() -> None:
+    circuit = Circuit()
+    for i in range(CIRCUIT_THRESHOLD):
+        assert not circuit.open
+        assert circuit.attempt(i)
+        circuit.record("timeout")
+    assert circuit.open
+    assert (circuit.failures, circuit.last_error) == (CIRCUIT_THRESHOLD, "timeout")
+
+    # an open circuit lets a single probe through once per interval
+    opened = circuit.last_attempt
+    assert not circuit.attempt(opened + 1)
+    assert not circuit.attempt(opened + CIRCUIT_PROBE_INTERVAL - 1)
+    assert circuit.attempt(opened + CIRCUIT_PROBE_INTERVAL)
+    assert not circuit.attempt(opened + CIRCUIT_PROBE_INTERVAL + 1)
+
+    circuit.record("timeout")
+    assert circuit.open
+    assert not circuit.attempt(opened + CIRCUIT_PROBE_INTERVAL + 2)
+
+
+def test_circuit_closes_on_success() -> None:
+    circuit = Circuit(failures=CIRCUIT_THRESHOLD + 3, last_error="timeout", last_attempt=0)
+    assert circuit.attempt(CIRCUIT_PROBE_INTERVAL)
+    circuit.record(None)
+    assert not circuit.open
+    assert (circuit.failures, circuit.last_error) == (0, None)
+    assert circuit.attempt(CIRCUIT_PROBE_INTERVAL + 1)
+
+
+def test_save_and_load(tmp_path: Path) -> None:
+    path = tmp_path / "state" / "circuits.json"
+    assert load_circuits(path) == {}
+
+    circuits = {"maston": Circuit(failures=2, last_error="Traceback", last_attempt=1234.5), "menza": Circuit()}
+    save_circuits(circuits, path)
+    assert load_circuits(path) == circuits
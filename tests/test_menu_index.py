@@ -0,0 +1,26 @@
+from lunches import Location, Lunch, RestaurantMenu, Soup
+from menu_index import NAME, build
+
+
+def test_search() -> None:
+    index = build(
+        [
+            RestaurantMenu(
+                "U Lva",
+                "https://example.com",
+                Location.Poruba,
+                id="lev",
+                soups=[Soup("Gulášová")],
+                lunches=[Lunch("Svíčková na smetaně"), Lunch("Smažený sýr")],
+            ),
+            RestaurantMenu("Bistro", "https://example.com", Location.Poruba, id="bistro", lunches=[Lunch("Svíčková")]),
+        ]
+    )
+
+    assert index.tokens["svickova"] == {"lev": [1], "bistro": [0]}
+    assert index.search("SVÍČK") == {"lev": {1}, "bistro": {0}}
+    assert index.search("svickova smet") == {"lev": {1}}
+    assert index.search("sm") == {"lev": {1, 2}}
+    assert index.search("lva gulas") == {"lev": {NAME, 0}}
+    assert index.search("svickova rizek") == {}
+    assert index.search("") == {}
@@ -0,0 +1,21 @@
+from metrics import Counter, Histogram, Registry
+
+
+def test_render() -> None:
+    registry = Registry()
+    errors = Counter("test_errors_total", "Errors", registry)
+    latency = Histogram("test_latency_seconds", "Latency", buckets=(0.1, 1), registry=registry)
+    errors.inc(restaurant='say "hi"')
+    errors.inc(2, restaurant='say "hi"')
+    latency.observe(0.1, host="a")
+    latency.observe(0.5, host="a")
+    latency.observe(3, host="a")
+
+    lines = registry.render().splitlines()
+    assert 'test_errors_total{restaurant="say \\"hi\\""} 3' in lines
+    assert "# TYPE test_latency_seconds histogram" in lines
+    assert 'test_latency_seconds_bucket{host="a",le="0.1"} 1' in lines
+    assert 'test_latency_seconds_bucket{host="a",le="1"} 2' in lines
+    assert 'test_latency_seconds_bucket{host="a",le="+Inf"} 3' in lines
+    assert 'test_latency_seconds_sum{host="a"} 3.6' in lines
+    assert 'test_latency_seconds_count{host="a"} 3' in lines
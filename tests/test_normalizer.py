@@ -0,0 +1,80 @@
+import random
+import re
+import string
+from html import unescape
+from pathlib import Path
+
+import pytest
+
+from lunches import normalize_name
+
+CORPUS = Path(__file__).parent / "fixtures" / "menu_names.txt"
+
+# the original chain of substitutions normalize_name() has to stay equivalent to
+REFERENCE_REPLACEMENTS = [
+    (re.compile(r"^\s*(Polévka|BUSINESS MENU|business|SALÁT TÝDNE|tip týdne)", re.IGNORECASE), ""),
+    (re.compile(r"(k menu|K POLEDNÍMU MENU ZDARMA)\s*$"), ""),
+    (re.compile(r"(s|š|S|Š)vestk"), "Trnk"),
+    (re.compile(r"(\d+)\s*kč", re.IGNORECASE), ""),
+    (re.compile(r"(\s*,)+"), ","),
+    (re.compile(r"\s*(,|:)\s*"), "\\1 "),
+    (re.compile(r"<[^<]+?>"), ""),
+    (re.compile(r"\d+\s*(g|ml|l|ks)( |,)"), ""),
+    (re.compile(r"A:\s*\d(\s*,\s*\d+,)*"), ""),
+    (re.compile(r"\s*A?l?\.?\s*\("), "("),
+    (re.compile(r"[0-9]+(\s*,\s*[0-9]+)+"), ""),
+    (re.compile(r"\([^)]+\)"), ""),
+    (re.compile(r"\s+"), " "),
+]
+REFERENCE_UPPER_REGEXP = re.compile(r"[A-ZÁČĎÉĚÍŇÓŘŠŤÚŮÝŽ]")
+
+
+def reference_fix_name(name: str) -> str:
+    name = unescape(name)
+    for pattern, replacement in REFERENCE_REPLACEMENTS:
+        name = pattern.sub(replacement, name)
+    name = name.strip(string.punctuation + string.whitespace + string.digits + "„–—\xa0")
+    uppers = len(REFERENCE_UPPER_REGEXP.findall(name))
+    if uppers > len(name) / 2:
+        name = name.lower()
+        name = name.capitalize()
+    return name
+
+
+def corpus() -> list[str]:
+    return CORPUS.read_text().splitlines()
+
+
+@pytest.mark.parametrize("name", corpus())
+def test_matches_reference(name: str) -> None:
+    assert normalize_name(name) == reference_fix_name(name)
+
+
+def test_matches_reference_on_random_fragments() -> None:
+    fragments = [
+        *(word for line in corpus() for word in re.split(r"(\W)", line)),
+        " ",
+        "  ",
+        "\t",
+        "\xa0",
+        ",",
+        " , ",
+        ":",
+        " : ",
+        "(",
+        ")",
+        "<br>",
+        "&amp;",
+        "A:",
+        "Al.",
+        "1,3,7",
+        "150g",
+        "0,33 l",
+        "4ks",
+        "159 Kč",
+        "149,-",
+    ]
+    rng = random.Random(42)
+    for _ in range(20000):
+        name = "".join(rng.choices(fragments, k=rng.randint(1, 12)))
+        assert normalize_name(name) == reference_fix_name(name), name
@@ -0,0 +1,156 @@
+import asyncio
+import datetime
+from collections.abc import Callable, Generator
+
+import httpx
+import pytest
+from selectolax.parser import Node
+
+import lunches
+from lunches import (
+    WEEKLY_RECHECK,
+    CachedPage,
+    Location,
+    Lunch,
+    RestaurantMenu,
+    RestaurantParser,
+    Soup,
+    create_client,
+    menicka_parser,
+    restaurant,
+)
+
+URL = "https://restaurant.example/menu"
+
+
+def fetch(
+    parser: RestaurantParser,
+    handler: Callable[[httpx.Request], httpx.Response],
+    page_cache: dict[str, CachedPage],
+) -> RestaurantMenu:
+    async def run() -> RestaurantMenu:
+        async with create_client(httpx.MockTransport(handler)) as client:
+            [menu] = await lunches.gather_restaurants([parser.name], page_cache, client=client, circuits={})
+            return menu
+
+    return asyncio.run(run())
+
+
+def test_unchanged_page_is_not_parsed_again(monkeypatch: pytest.MonkeyPatch) -> None:
+    parsed = []
+
+    @restaurant("Daily", URL, Location.Poruba)
+    def daily(dom: Node) -> Generator[Soup | Lunch]:
+        parsed.append(dom)
+        yield Lunch(dom.css("p")[0].text(), price="120 Kč")
+
+    monkeypatch.setitem(lunches.RESTAURANTS, daily.name, daily)
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"v1"' and len(requests) == 2:
+            return httpx.Response(304)
+        headers = {"ETag": '"v1"', "Last-Modified": "Mon, 02 Mar 2026 08:00:00 GMT"}
+        return httpx.Response(200, headers=headers, html="<p>Řízek</p>")
+
+    page_cache: dict[str, CachedPage] = {}
+    first = fetch(daily, handler, page_cache)
+    assert (first.lunches, first.error) == ([Lunch("Řízek", num=1, price=120)], None)
+
+    # the server confirms our copy, then sends the same page again
+    not_modified = fetch(daily, handler, page_cache)
+    identical = fetch(daily, handler, page_cache)
+    assert len(parsed) == 1
+    assert not_modified.lunches == identical.lunches == first.lunches
+    assert identical.last_fetch >= first.last_fetch
+    for request in requests[1:]:
+        assert request.headers["If-None-Match"] == '"v1"'
+        assert request.headers["If-Modified-Since"] == "Mon, 02 Mar 2026 08:00:00 GMT"
+
+    # a changed page is parsed
+    def changed(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, headers={"ETag": '"v2"'}, html="<p>Guláš</p>")
+
+    assert fetch(daily, changed, page_cache).lunches[0].name == "Guláš"
+    assert len(parsed) == 2
+
+
+def menicka_page(closed: datetime.date | None = None) -> str:
+    days = []
+    for day in lunches.week_days(datetime.datetime.now(lunches.TZ).date()):
+        if day == closed:
+            foods = '<div class="soup"><div class="food">Restaurace má tento den zavřeno.</div></div>'
+        else:
+            name = lunches.days[day.weekday()]
+            foods = (
+                f'<div class="soup"><div class="food">Vývar {name}</div><div class="prize">30 Kč</div></div>'
+                f'<div class="main"><span class="no">1.</span><span class="food">Řízek {name}</span>'
+                '<span class="prize">150 Kč</span></div>'
+            )
+        days.append(f'<div class="content"><h2>Den {day:%-d.%-m.%Y}</h2>{foods}</div>')
+    return "".join(days)
+
+
+def test_weekly_page(monkeypatch: pytest.MonkeyPatch) -> None:
+    today = datetime.datetime.now(lunches.TZ).date()
+    broken = next(day for day in lunches.week_days(today) if day != today)
+    parsed: list[datetime.date] = []
+
+    @restaurant("Weekly", URL, Location.Poruba)
+    def weekly(dom: Node, day: datetime.date) -> Generator[Soup | Lunch]:
+        parsed.append(day)
+        if day == broken:
+            dom.css(".missing")[0].text()
+        yield from menicka_parser(dom, day)
+
+    monkeypatch.setitem(lunches.RESTAURANTS, weekly.name, weekly)
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"week"' and len(requests) == 2:
+            return httpx.Response(304)
+        return httpx.Response(200, headers={"ETag": '"week"'}, html=menicka_page())
+
+    # every day of the week is parsed from a single download, the broken day is just skipped
+    page_cache: dict[str, CachedPage] = {}
+    first = fetch(weekly, handler, page_cache)
+    assert first.error is None
+    assert [soup.name for soup in first.soups] == [f"Vývar {lunches.days[today.weekday()]}"]
+    assert len(parsed) == 7
+    assert len(page_cache["weekly"].menus) == 6
+    assert broken.isoformat() not in page_cache["weekly"].menus
+
+    # within the recheck interval the page is not even downloaded
+    assert fetch(weekly, handler, page_cache).lunches == first.lunches
+    assert (len(requests), len(parsed)) == (1, 7)
+
+    # later it is checked for changes, neither a 304 nor the same page are parsed again
+    for _ in range(2):
+        page_cache["weekly"].checked -= WEEKLY_RECHECK
+        assert fetch(weekly, handler, page_cache).lunches == first.lunches
+        assert requests[-1].headers["If-None-Match"] == '"week"'
+    assert (len(requests), len(parsed)) == (3, 7)
+
+
+def test_weekly_page_without_today(monkeypatch: pytest.MonkeyPatch) -> None:
+    today = datetime.datetime.now(lunches.TZ).date()
+
+    @restaurant("Weekly", URL, Location.Poruba)
+    def weekly(dom: Node, day: datetime.date) -> Generator[Soup | Lunch]:
+        yield from menicka_parser(dom, day)
+
+    monkeypatch.setitem(lunches.RESTAURANTS, weekly.name, weekly)
+    pages = [menicka_page(closed=today), menicka_page()]
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, html=pages.pop(0))
+
+    # today's empty menu is fetched again right away, the restaurant may just not have filled it in yet
+    page_cache: dict[str, CachedPage] = {}
+    assert fetch(weekly, handler, page_cache).lunches == []
+    assert [food.name for food in fetch(weekly, handler, page_cache).lunches] == [
+        f"Řízek {lunches.days[today.weekday()]}"
+    ]
+    assert pages == []
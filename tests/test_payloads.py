@@ -0,0 +1,113 @@
+import dataclasses
+import gzip
+
+import brotli
+from starlette.requests import Request
+
+from app import (
+    LunchResponse,
+    accepted_encoding,
+    content_hash,
+    encode_payload,
+    encode_payloads,
+    filter_payload,
+    payload_response,
+)
+from lunches import Location, Lunch, RestaurantMenu
+
+
+def request(**headers: str) -> Request:
+    raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "headers": raw})
+
+
+def test_encode_payload() -> None:
+    payload = encode_payload(LunchResponse(last_fetch=1, fetch_count=2, restaurants=[]))
+    assert gzip.decompress(payload[b"gzip"]) == brotli.decompress(payload[b"br"]) == payload[b"identity"]
+    assert LunchResponse.model_validate_json(payload[b"identity"]).fetch_count == 2
+    assert encode_payload(LunchResponse(last_fetch=1, fetch_count=2, restaurants=[]))[b"etag"] == payload[b"etag"]
+    assert encode_payload(LunchResponse(last_fetch=1, fetch_count=3, restaurants=[]))[b"etag"] != payload[b"etag"]
+    assert set(encode_payload(LunchResponse(last_fetch=1, fetch_count=2, restaurants=[]), ("gzip",))) == {
+        b"etag",
+        b"identity",
+        b"gzip",
+    }
+
+
+def test_accepted_encoding() -> None:
+    payload = encode_payload(LunchResponse(last_fetch=1, fetch_count=2, restaurants=[]))
+    assert accepted_encoding(request(accept_encoding="gzip, deflate, br"), payload) == "br"
+    assert accepted_encoding(request(accept_encoding="br;q=0, gzip"), payload) == "gzip"
+    assert accepted_encoding(request(accept_encoding="br; q=0.0, gzip;q=0"), payload) == "identity"
+    assert accepted_encoding(request(accept_encoding="br;q=0.5"), payload) == "br"
+    assert accepted_encoding(request(accept_encoding="zstd"), payload) == "identity"
+    assert accepted_encoding(request(), payload) == "identity"
+    # encodings missing in the payload fall back to identity
+    del payload[b"br"]
+    assert accepted_encoding(request(accept_encoding="br"), payload) == "identity"
+
+
+def test_payload_response() -> None:
+    payload = encode_payload(LunchResponse(last_fetch=1, fetch_count=2, restaurants=[]))
+    etag = payload[b"etag"].decode()
+
+    response = payload_response(request(accept_encoding="gzip"), payload, {"X-Stale": "0"})
+    assert response.status_code == 200
+    assert response.body == payload[b"gzip"]
+    assert response.headers["ETag"] == f'"{etag}-gzip"'
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["X-Stale"] == "0"
+
+    identity = payload_response(request(), payload, {})
+    assert identity.body == payload[b"identity"]
+    assert identity.headers["ETag"] == f'"{etag}"'
+    assert "Content-Encoding" not in identity.headers
+
+    # every encoding has its own etag, so a cached gzip body is not confirmed to a client asking for brotli
+    not_modified = payload_response(request(accept_encoding="gzip", if_none_match=f'"x", "{etag}-gzip"'), payload, {})
+    assert (not_modified.status_code, not_modified.body) == (304, b"")
+    assert not_modified.headers["ETag"] == f'"{etag}-gzip"'
+    assert (
+        payload_response(request(accept_encoding="br", if_none_match=f'"{etag}-gzip"'), payload, {}).status_code == 200
+    )
+
+
+def menus() -> dict[str, RestaurantMenu]:
+    return {
+        "bistroin": RestaurantMenu("Bistro IN", "https://bistro.example", Location.Poruba, id="bistroin"),
+        "maston": RestaurantMenu("Maston", "https://maston.example", Location.Dubina, id="maston"),
+    }
+
+
+def test_refetched_content_keeps_hash() -> None:
+    menu = menus()["maston"]
+    menu.lunches = [Lunch("Řízek", num=1, price=150)]
+    refetched = dataclasses.replace(menu, last_fetch=menu.last_fetch + 60, elapsed=1.5)
+    # a slow restaurant is written as pending at the refresh deadline, its content did not change
+    pending = dataclasses.replace(refetched, pending=True)
+    assert content_hash(menu) == content_hash(refetched) == content_hash(pending)
+    assert content_hash(dataclasses.replace(menu, lunches=[Lunch("Guláš", num=1, price=150)])) != content_hash(menu)
+
+
+def test_filter_payload() -> None:
+    restaurants = menus()
+    restaurants["bistroin"].lunches = [Lunch("Svíčková na smetaně", num=1)]
+    restaurants["maston"].lunches = [Lunch("Řízek", num=1)]
+    payloads = encode_payloads(list(restaurants), restaurants, 3, version=7, versions={"bistroin": 5, "maston": 7})
+    payload, _ = payloads[None]
+
+    def ids(since: int | None, query: str | None = None) -> tuple[int | None, list[str], list[str]]:
+        result = LunchResponse.model_validate_json(
+            gzip.decompress(filter_payload(None, payload, query, since)[b"gzip"])
+        )
+        return result.since, [menu.id for menu in result.restaurants], sorted(result.hashes)
+
+    # every version carries all the hashes, so the client knows which restaurants it keeps
+    assert ids(5) == (5, ["maston"], ["bistroin", "maston"])
+    assert ids(4) == (4, ["bistroin", "maston"], ["bistroin", "maston"])
+    assert ids(7) == (7, [], ["bistroin", "maston"])
+    # redis lost the version counter, the client gets everything again
+    assert ids(8) == (None, ["bistroin", "maston"], ["bistroin", "maston"])
+    assert ids(None, "svickova") == (None, ["bistroin"], ["bistroin", "maston"])
+    assert ids(5, "svickova") == (5, [], ["bistroin", "maston"])
@@ -0,0 +1,70 @@
+import asyncio
+import datetime
+
+import httpx
+import pytest
+import redis.asyncio as redis
+
+import public_transport
+from public_transport import TZ, Connection, Link, Station, public_transport_connections
+
+
+def link(departure: int, arrival: int, line: str = "7", stop: str = "Hlavní třída") -> Link:
+    now = datetime.datetime.now(TZ).replace(second=0, microsecond=0)
+    return Link(
+        total=arrival - departure,
+        connections=[
+            Connection(
+                link=line,
+                from_=Station(time=now + datetime.timedelta(minutes=departure), station="Václava Jiřikovského"),
+                to=Station(time=now + datetime.timedelta(minutes=arrival), station=stop),
+            )
+        ],
+    )
+
+
+def connections(
+    monkeypatch: pytest.MonkeyPatch,
+    results: dict[str, list[Link]],
+    window: datetime.timedelta | None = None,
+    limit: int | None = None,
+) -> list[tuple[str, int, str]]:
+    async def cached_links(
+        http: httpx.AsyncClient, source: str, destination: str, redis_client: redis.Redis | None
+    ) -> list[Link]:
+        return results[destination]
+
+    monkeypatch.setattr(public_transport, "cached_links", cached_links)
+    links = asyncio.run(
+        public_transport_connections(["Václava Jiřikovského"], list(results), None, None, window, limit)
+    )
+    return [(link.connections[0].link, link.total, link.connections[-1].to.station) for link in links]
+
+
+def test_merged_by_departure(monkeypatch: pytest.MonkeyPatch) -> None:
+    results = {
+        "Hlavní třída": [link(-2, 5), link(1, 12), link(4, 9, "8"), link(70, 80, "9")],
+        "Pustkovecká": [link(1, 8, stop="Pustkovecká"), link(3, 9, "4", "Pustkovecká")],
+    }
+    # the same trip reachable at both stops is kept once with the earliest arrival, the departed one is dropped
+    assert connections(monkeypatch, results) == [
+        ("7", 7, "Pustkovecká"),
+        ("4", 6, "Pustkovecká"),
+        ("8", 5, "Hlavní třída"),
+        ("9", 10, "Hlavní třída"),
+    ]
+    assert connections(monkeypatch, results, window=datetime.timedelta(minutes=60)) == [
+        ("7", 7, "Pustkovecká"),
+        ("4", 6, "Pustkovecká"),
+        ("8", 5, "Hlavní třída"),
+    ]
+    assert connections(monkeypatch, results, limit=2) == [("7", 7, "Pustkovecká"), ("4", 6, "Pustkovecká")]
+
+
+def test_ties_settled_by_arrival(monkeypatch: pytest.MonkeyPatch) -> None:
+    # IDOS does not promise any order of connections leaving at the same time
+    results = {"Hlavní třída": [link(2, 20), link(2, 10, "2")], "Pustkovecká": [link(2, 15, stop="Pustkovecká")]}
+    assert connections(monkeypatch, results) == [
+        ("2", 8, "Hlavní třída"),
+        ("7", 13, "Pustkovecká"),
+    ]
@@ -0,0 +1,38 @@
+import asyncio
+import gzip
+from pathlib import Path
+
+import httpx
+
+from lunches import RecordingTransport, create_client, replay_transport
+
+PAGE = "<html><body>Polévka dne: Gulášová</body></html>".encode("windows-1250")
+
+
+def upstream(request: httpx.Request) -> httpx.Response:
+    if request.url.path == "/missing":
+        return httpx.Response(404)
+    return httpx.Response(
+        200,
+        headers={"Content-Encoding": "gzip", "Content-Type": "text/html; charset=windows-1250", "ETag": '"v1"'},
+        content=gzip.compress(PAGE),
+    )
+
+
+def test_record_and_replay(tmp_path: Path) -> None:
+    async def fetch(transport: httpx.AsyncBaseTransport, url: str) -> httpx.Response:
+        async with create_client(transport) as client:
+            return await client.get(url)
+
+    url = "https://restaurant.example/menu?day=1"
+    recorded = asyncio.run(fetch(RecordingTransport(tmp_path, httpx.MockTransport(upstream)), url))
+    asyncio.run(
+        fetch(RecordingTransport(tmp_path, httpx.MockTransport(upstream)), "https://restaurant.example/missing")
+    )
+    replayed = asyncio.run(fetch(replay_transport(tmp_path), url))
+
+    assert recorded.content == replayed.content == PAGE
+    assert replayed.text == recorded.text == "<html><body>Polévka dne: Gulášová</body></html>"
+    assert replayed.headers["ETag"] == '"v1"'
+    assert asyncio.run(fetch(replay_transport(tmp_path), "https://restaurant.example/missing")).status_code == 404
+    assert asyncio.run(fetch(replay_transport(tmp_path), "https://restaurant.example/other")).status_code == 404